@@ -0,0 +1,82 @@
+import asyncio
+import threading
+import weakref
+
+
+class Call:
+    """
+    A single computation, that concurrent callers wait for
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key within a worker.
+    The first caller computes the result, all callers arriving until it is finished wait and get the same result or exception.
+    Afterwards, the key is forgotten, so nothing is cached beyond the computation.
+    The result is shared, so callers must not change it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # asyncio futures are bound to their event loop
+        self._futures = weakref.WeakKeyDictionary()
+
+    def do(self, key, function):
+        """
+        Returns the result of function, which is called only once for concurrent calls with the same key
+        Safe to use from several threads
+        :param key: Hashable key identifying the computation
+        :param function: Function without arguments
+        :return: Result of function
+        :raises: The exception of function
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+        return call.result
+
+    async def do_async(self, key, function):
+        """
+        Like do, but for coroutines, e.g. in async views
+        The function is run in the default executor, concurrent coroutines with the same key await the same future.
+        Since it uses do, coroutines and threads are coalesced as well.
+        A cancelled caller does not cancel the computation for the others.
+        :param key: Hashable key identifying the computation
+        :param function: Function without arguments, it may block
+        :return: Result of function
+        """
+        loop = asyncio.get_event_loop()
+        futures = self._futures.setdefault(loop, {})
+
+        future = futures.get(key)
+        if future is None:
+            future = futures[key] = loop.run_in_executor(None, self.do, key, function)
+            future.add_done_callback(lambda f: futures.pop(key, None))
+
+        return await asyncio.shield(future)
@@ -0,0 +1,91 @@
+from urllib.parse import urlparse
+
+# Second level labels that are shared by many institutions, e.g. ac.uk or edu.au
+# Parent domains starting with these are too generic to point to a single IdP
+GENERIC_LABELS = {'ac', 'co', 'com', 'edu', 'gov', 'net', 'org'}
+
+
+def normalize_domain(domain):
+    """
+    Strips an optional local part of an email address, whitespace and dots and returns the domain in lower case
+    :param domain: Domain or email address
+    :return: string
+    """
+    return domain.rsplit('@', 1)[-1].strip().strip('.').lower()
+
+
+def get_host(url):
+    """
+    Returns the host of an URL or None, if the URL has no host
+    """
+    try:
+        return urlparse(url).hostname
+    except ValueError:
+        return None
+
+
+def get_parent_domains(domain):
+    """
+    Returns the domain and its parents, most specific first.
+    Top level domains and generic second level domains are left out
+    :param domain: Domain in lower case
+    :return: List of domains
+    """
+    labels = domain.split('.')
+    return [
+        '.'.join(labels[i:]) for i in range(len(labels) - 1)
+        if i == 0 or labels[i] not in GENERIC_LABELS or len(labels) - i > 2
+    ]
+
+
+def build_domain_index(idps):
+    """
+    Builds a dictionary of domains pointing to IdPs.
+    The strategy is the following:
+    Domain hints and scopes of an IdP are most reliable, so they come first.
+    Then the hosts of the entityID and the InformationURLs follow and at last their parent domains.
+    This way, the IdP belonging to a domain is found with a single dictionary lookup per domain level
+    :param idps: IdPs as prepared by prepare_data
+    :return: Dictionary of domains and lists of positions
+    """
+    hints = []
+    hosts = []
+    for idp in idps:
+        hints.append([normalize_domain(domain) for domain in idp.get('domain_hints', []) + idp.get('scopes', [])])
+        urls = [idp.get('entity_id') or ''] + list(idp.get('information_url', {}).values())
+        hosts.append([host for host in map(get_host, urls) if host])
+
+    # Positions are collected in dictionaries as ordered sets, since many IdPs may share a domain
+    domains = {}
+
+    def add(domain, position):
+        domains.setdefault(domain, {}).setdefault(position, None)
+
+    for position, idp_hints in enumerate(hints):
+        for domain in idp_hints:
+            add(domain, position)
+
+    for position, idp_hosts in enumerate(hosts):
+        for host in idp_hosts:
+            add(host, position)
+
+    for position, idp_hosts in enumerate(hosts):
+        for host in idp_hosts:
+            for domain in get_parent_domains(host)[1:]:
+                add(domain, position)
+
+    return {domain : list(positions) for domain, positions in domains.items()}
+
+
+def lookup(query, domain_index):
+    """
+    Finds the IdPs of a domain or email address, walking up to the parent domains until IdPs are found
+    :param query: Domain or email address, e.g. user@tu-darmstadt.de
+    :param domain_index: as built by build_domain_index
+    :return: List of positions
+    """
+    for domain in get_parent_domains(normalize_domain(query)):
+        if domain in domain_index:
+            return domain_index[domain]
+
+    return []
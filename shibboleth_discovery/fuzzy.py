@@ -0,0 +1,114 @@
+from functools import partial
+
+from shibboleth_discovery.parallel import CHUNK_SIZE
+from shibboleth_discovery.parallel import map_chunks
+
+# Shorter tokens are too ambiguous to be corrected
+MIN_LENGTH = 4
+
+
+def get_deletes(word, distance):
+    """
+    Returns all strings that can be created by deleting up to distance characters from word
+    :param word: string
+    :param distance: Maximum number of deletions
+    :return: set of strings, including word itself
+    """
+    deletes = {word}
+    frontier = {word}
+    for _ in range(distance):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        deletes |= frontier
+    return deletes
+
+
+def edit_distance(a, b, distance):
+    """
+    Computes the optimal string alignment distance, i.e. Levenshtein distance with transpositions
+    :param a: string
+    :param b: string
+    :param distance: Maximum distance of interest
+    :return: Distance or distance + 1 if it is larger
+    """
+    if abs(len(a) - len(b)) > distance:
+        return distance + 1
+
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > distance:
+            return distance + 1
+        previous2, previous = previous, current
+
+    return min(previous[-1], distance + 1)
+
+
+def get_token_deletes(tokens, distance):
+    """
+    Returns the deletes of each token in sorted order, so that the index does not depend on the hash seed
+    Tokens shorter than MIN_LENGTH get no deletes
+    :param tokens: List of tokens
+    :param distance: Maximum edit distance
+    :return: List of lists of strings
+    """
+    return [sorted(get_deletes(token, distance)) if len(token) >= MIN_LENGTH else [] for token in tokens]
+
+
+def build_fuzzy_index(index, distance, executor=None, chunk_size=CHUNK_SIZE):
+    """
+    Builds the deletion dictionary over the tokens of the index (SymSpell).
+    For each token all strings reachable by deleting up to distance characters are stored.
+    A search token is looked up by its own deletes, which yields candidates that are verified by their edit distance.
+    :param index: List of lower case names, as prepared by prepare_data
+    :param distance: Maximum edit distance
+    :param executor: Executor to compute the deletes of chunks of tokens in parallel, see map_chunks
+    :param chunk_size: Number of tokens per chunk
+    :return: Dictionary containing the distance, the deletes and the positions of each token
+    """
+    positions = {}
+    for position, entry in enumerate(index):
+        for token in entry.split():
+            positions.setdefault(token, []).append(position)
+
+    deletes = {}
+    if distance > 0:
+        tokens = list(positions)
+        token_deletes = map_chunks(partial(get_token_deletes, distance=distance), tokens, executor, chunk_size)
+        for token, token_delete in zip(tokens, token_deletes):
+            for delete in token_delete:
+                deletes.setdefault(delete, []).append(token)
+
+    return {
+        'distance' : distance,
+        'deletes' : deletes,
+        'positions' : positions,
+    }
+
+
+def lookup(token, fuzzy_index):
+    """
+    Finds all tokens of the index within the edit distance of token
+    :param token: lower case search token
+    :param fuzzy_index: as built by build_fuzzy_index
+    :return: Set of positions of IdPs having a similar token
+    """
+    distance = fuzzy_index['distance']
+    if distance <= 0 or len(token) < MIN_LENGTH:
+        return set()
+
+    candidates = set()
+    for delete in get_deletes(token, distance):
+        candidates.update(fuzzy_index['deletes'].get(delete, []))
+
+    positions = set()
+    for candidate in candidates:
+        if edit_distance(token, candidate, distance) <= distance:
+            positions.update(fuzzy_index['positions'][candidate])
+
+    return positions
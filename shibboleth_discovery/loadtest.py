@@ -0,0 +1,288 @@
+import json
+import math
+import random
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urljoin
+
+import requests
+
+from django.core.cache import caches
+from django.utils.crypto import get_random_string
+
+# Syllables to make up names of synthetic IdPs, so that prefixes are shared like in real feeds
+SYLLABLES = ['an', 'ber', 'burg', 'dam', 'del', 'furt', 'gen', 'ham', 'hau', 'kas', 'lin', 'mar', 'mun', 'sel', 'stadt', 'tor', 'ul', 'wald']
+KINDS = [
+    ('University of {}', 'Universität {}'),
+    ('{} University of Applied Sciences', 'Hochschule {}'),
+    ('Technical University of {}', 'Technische Universität {}'),
+    ('{} Library', 'Bibliothek {}'),
+]
+
+# Methods of the cache backend, that each cost a round trip to the cache server
+CACHE_METHODS = ('add', 'get', 'set', 'delete', 'get_many', 'set_many', 'delete_many', 'incr', 'decr', 'touch')
+
+
+def make_feed(size, seed=0):
+    """
+    Creates a DiscoFeed of synthetic IdPs, e.g. to test the size of eduGAIN
+    :param size: Number of IdPs
+    :param seed: Seed, the same seed gives the same feed
+    :return: DiscoFeed as python object
+    """
+    rng = random.Random(seed)
+    feed = []
+    for number in range(size):
+        city = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))).capitalize()
+        english, german = rng.choice(KINDS)
+        domain = '{}{}.example.org'.format(city.lower(), number)
+        feed.append({
+            'entityID' : 'https://idp.{}/idp/shibboleth'.format(domain),
+            'DisplayNames' : [
+                {'value' : english.format(city), 'lang' : 'en'},
+                {'value' : german.format(city), 'lang' : 'de'},
+            ],
+            'InformationURLs' : [
+                {'value' : 'https://www.{}/'.format(domain), 'lang' : 'en'},
+            ],
+            'Scopes' : [domain],
+        })
+    return feed
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of sorted values by the nearest rank method
+    :param values: Sorted list of numbers
+    :param p: Percentile between 0 and 100
+    :return: Number or None if there are no values
+    """
+    if not values:
+        return None
+    rank = math.ceil(p * len(values) / 100)
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class CacheCounter:
+    """
+    Counts the calls of the cache backend, that go to the cache server
+    Calls made within other calls, e.g. get_many of the local memory cache calling get, are counted once
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def wrap(self, method):
+        def counted(*args, **kwargs):
+            depth = getattr(self._local, 'depth', 0)
+            if depth == 0:
+                with self._lock:
+                    self.calls += 1
+            self._local.depth = depth + 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._local.depth = depth
+        return counted
+
+    @contextmanager
+    def patch(self, backend=None):
+        """
+        Counts the calls of the class of a cache backend while the context is active
+        Each thread has its own backend instance, so the class is patched
+        :param backend: Cache backend, the default cache if not given
+        """
+        cls = type(backend if backend is not None else caches['default'])
+        originals = {name : cls.__dict__[name] for name in CACHE_METHODS if name in cls.__dict__}
+        inherited = [name for name in CACHE_METHODS if name not in cls.__dict__ and hasattr(cls, name)]
+        for name in list(originals) + inherited:
+            setattr(cls, name, self.wrap(getattr(cls, name)))
+        try:
+            yield self
+        finally:
+            for name, method in originals.items():
+                setattr(cls, name, method)
+            for name in inherited:
+                delattr(cls, name)
+
+
+class LocalClient:
+    """
+    Sends requests in this process via the Django test client
+    """
+
+    def __init__(self):
+        from django.test import Client
+        self.client = Client()
+
+    def get(self, path, params):
+        response = self.client.get(path, params)
+        return response.status_code, response.content
+
+    def post(self, path, data):
+        response = self.client.post(path, json.dumps(data), content_type='application/json')
+        return response.status_code, response.content
+
+
+class RemoteClient:
+    """
+    Sends requests to a running server, e.g. python manage.py runserver
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.session = requests.Session()
+        # Django accepts a CSRF token chosen by the client, as long as cookie and header match
+        self.csrf_token = get_random_string(64)
+        self.session.cookies.set('csrftoken', self.csrf_token)
+
+    def get(self, path, params):
+        response = self.session.get(urljoin(self.base_url, path), params=params, allow_redirects=False, timeout=30)
+        return response.status_code, response.content
+
+    def post(self, path, data):
+        response = self.session.post(
+            urljoin(self.base_url, path),
+            data=json.dumps(data),
+            headers={'Content-Type' : 'application/json', 'X-CSRFToken' : self.csrf_token},
+            timeout=30
+        )
+        return response.status_code, response.content
+
+
+class LoadTest:
+    """
+    Simulates users, that type the name of their IdP letter by letter and log in.
+    Each session types prefixes of a random IdP until it shows up in the results, remembers it and redirects.
+    Returning users reuse the cookies of an earlier session and log in with their recent IdP without searching.
+    """
+
+    def __init__(self, idps, urls, client_factory, sessions=100, concurrency=10, cookie_reuse=0.3, keystroke_delay=0, seed=0, query_parameter='q'):
+        """
+        :param idps: List of tuples of entityID and name of the IdPs, users are looking for
+        :param urls: Dictionary with the paths of search, redirect and remember-idp
+        :param client_factory: Function returning a new LocalClient or RemoteClient
+        :param sessions: Number of sessions
+        :param concurrency: Number of sessions running at the same time
+        :param cookie_reuse: Share of sessions of returning users
+        :param keystroke_delay: Seconds between two keystrokes
+        :param seed: Seed for choosing IdPs and returning users
+        :param query_parameter: GET parameter of the query, see SHIB_DS_QUERY_PARAMETER
+        """
+        self.idps = idps
+        self.urls = urls
+        self.client_factory = client_factory
+        self.sessions = sessions
+        self.concurrency = concurrency
+        self.cookie_reuse = cookie_reuse
+        self.keystroke_delay = keystroke_delay
+        self.rng = random.Random(seed)
+        self.query_parameter = query_parameter
+
+        self._lock = threading.Lock()
+        self._returning = []
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def request(self, endpoint, send, *args):
+        start = time.perf_counter()
+        status, content = send(*args)
+        latency = time.perf_counter() - start
+        with self._lock:
+            self.latencies[endpoint].append(latency)
+            if status >= 400:
+                self.errors[endpoint] += 1
+        return status, content
+
+    def plan(self):
+        """
+        Decides in advance about all sessions, so that the same seed results in the same traffic
+        """
+        return [(self.rng.random() < self.cookie_reuse, self.rng.choice(self.idps)) for _ in range(self.sessions)]
+
+    def run_session(self, returning, idp):
+        client, entity_id = None, None
+        if returning:
+            with self._lock:
+                if self._returning:
+                    client, entity_id = self._returning.pop(self.rng.randrange(len(self._returning)))
+
+        if client is None:
+            client = self.client_factory()
+            entity_id, name = idp
+            # The user types the name until the IdP shows up
+            query = ''
+            for character in name:
+                query += character
+                if not query.strip():
+                    continue
+                status, content = self.request('search', client.get, self.urls['search'], {self.query_parameter : query})
+                if status == 200 and entity_id in content.decode('utf-8'):
+                    break
+                if self.keystroke_delay:
+                    time.sleep(self.keystroke_delay)
+            self.request('remember-idp', client.post, self.urls['remember-idp'], {'entity_id' : entity_id})
+
+        self.request('redirect', client.get, self.urls['redirect'], {'entityID' : entity_id, 'next' : '/'})
+
+        with self._lock:
+            self._returning.append((client, entity_id))
+
+    def run(self):
+        """
+        Runs all sessions and returns the duration in seconds
+        """
+        plan = iter(self.plan())
+        plan_lock = threading.Lock()
+
+        def worker():
+            while True:
+                with plan_lock:
+                    session = next(plan, None)
+                if session is None:
+                    return
+                self.run_session(*session)
+
+        threads = [threading.Thread(target=worker) for _ in range(self.concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return time.perf_counter() - start
+
+    def report(self, duration, cache_calls=None):
+        """
+        Returns the statistics per endpoint and in total
+        :param duration: Duration of the run in seconds
+        :param cache_calls: Number of calls to the cache or None if unknown
+        :return: Dictionary of endpoints and dictionaries of statistics, latencies in milliseconds
+        """
+        stats = {}
+        endpoints = list(self.latencies) + ['total']
+        for endpoint in endpoints:
+            if endpoint == 'total':
+                latencies = sorted(latency for values in self.latencies.values() for latency in values)
+                errors = sum(self.errors.values())
+            else:
+                latencies = sorted(self.latencies[endpoint])
+                errors = self.errors[endpoint]
+            stats[endpoint] = {
+                'requests' : len(latencies),
+                'errors' : errors,
+                'throughput' : len(latencies) / duration if duration else 0,
+                'p50' : percentile(latencies, 50) * 1000 if latencies else None,
+                'p90' : percentile(latencies, 90) * 1000 if latencies else None,
+                'p99' : percentile(latencies, 99) * 1000 if latencies else None,
+                'max' : latencies[-1] * 1000 if latencies else None,
+            }
+        if cache_calls is not None:
+            stats['total']['cache_calls'] = cache_calls
+            stats['total']['cache_calls_per_request'] = cache_calls / stats['total']['requests'] if stats['total']['requests'] else 0
+        return stats
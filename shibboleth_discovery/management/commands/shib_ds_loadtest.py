@@ -0,0 +1,209 @@
+import json
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from shibboleth_discovery.loadtest import CacheCounter
+from shibboleth_discovery.loadtest import LoadTest
+from shibboleth_discovery.loadtest import LocalClient
+from shibboleth_discovery.loadtest import RemoteClient
+from shibboleth_discovery.loadtest import make_feed
+from shibboleth_discovery.popularity import flush
+from shibboleth_discovery.popularity import get_counter_key
+from shibboleth_discovery.popularity import get_popular_key
+from shibboleth_discovery.profiles import get_profile
+from shibboleth_discovery.storage import get_part_key
+from shibboleth_discovery.storage import get_shard_key
+from shibboleth_discovery.storage import read_version
+from shibboleth_discovery.utils import get_or_set_prepared
+
+# In process, the load test runs with its own profile, so that its selections do not mix with real ones
+LOADTEST_PROFILE = 'shib_ds_loadtest'
+
+class Command(BaseCommand):
+    help = "Simulates users typing the names of their IdPs and reports latencies, throughput and cache round trips"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sessions',
+            type=int,
+            default=100,
+            help="Number of simulated logins."
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=10,
+            help="Number of logins at the same time."
+        )
+        parser.add_argument(
+            '--cookie-reuse',
+            type=float,
+            default=0.3,
+            help="Share of returning users, that log in with their recent IdP from cookie."
+        )
+        parser.add_argument(
+            '--feed-size',
+            type=int,
+            help="Number of synthetic IdPs. By default, the configured DiscoFeed is used."
+        )
+        parser.add_argument(
+            '--keystroke-delay',
+            type=float,
+            default=0,
+            help="Seconds between two keystrokes."
+        )
+        parser.add_argument(
+            '--url',
+            help="Base URL of a running server, e.g. http://localhost:8000. By default, requests are handled in this process."
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help="Seed for the synthetic DiscoFeed and the simulated users."
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help="Output the statistics as JSON."
+        )
+
+    def handle(self, *args, **options):
+        if options.get('sessions') < 1 or options.get('concurrency') < 1:
+            raise CommandError("--sessions and --concurrency must be at least 1")
+        if not 0 <= options.get('cookie_reuse') <= 1:
+            raise CommandError("--cookie-reuse must be between 0 and 1")
+        if options.get('feed_size') is not None and options.get('feed_size') < 1:
+            raise CommandError("--feed-size must be at least 1")
+        if options.get('url') and options.get('feed_size'):
+            raise CommandError("--feed-size is only available without --url, since the server uses its own DiscoFeed")
+
+        if options.get('url'):
+            stats = self.run_remote(options)
+        else:
+            stats = self.run_local(options)
+
+        if options.get('json'):
+            self.stdout.write(json.dumps(stats, indent=2))
+        else:
+            self.report(stats)
+
+    def get_load_test(self, profile, urls, client_factory, options):
+        """
+        Creates the load test for the IdPs of a profile
+        """
+        version, data = get_or_set_prepared(profile)
+        idps = [
+            (idp.get('entity_id'), idp.get('name', {}).get('en') or next(iter(idp.get('name', {}).values()), ''))
+            for idp in data['idps']
+        ]
+        if not idps:
+            raise CommandError("The DiscoFeed contains no IdPs")
+
+        return LoadTest(
+            idps,
+            urls,
+            client_factory,
+            sessions=options.get('sessions'),
+            concurrency=options.get('concurrency'),
+            cookie_reuse=options.get('cookie_reuse'),
+            keystroke_delay=options.get('keystroke_delay'),
+            seed=options.get('seed'),
+            query_parameter=profile.QUERY_PARAMETER,
+        )
+
+    def run_remote(self, options):
+        """
+        Sends the requests to a running server, its cache round trips are unknown
+        """
+        urls = {name : reverse('shib_ds:{}'.format(name)) for name in ('search', 'redirect', 'remember-idp')}
+        load_test = self.get_load_test(get_profile(), urls, lambda: RemoteClient(options.get('url')), options)
+
+        return load_test.report(load_test.run())
+
+    def run_local(self, options):
+        """
+        Handles the requests in this process with a profile of its own
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            # The snapshot of the real DiscoFeed must neither be replaced nor used for the synthetic one
+            overrides = {'SP_URL' : settings.SHIB_DS_SP_URL, 'SNAPSHOT_PATH' : None}
+            if options.get('feed_size'):
+                path = os.path.join(directory, 'DiscoFeed.json')
+                with open(path, 'w') as fout:
+                    json.dump(make_feed(options.get('feed_size'), options.get('seed')), fout)
+                overrides.update({'DISCOFEED_PATH' : path, 'DISCOFEED_URL' : None})
+
+            with override_settings(
+                SHIB_DS_PROFILES=dict(settings.SHIB_DS_PROFILES, **{LOADTEST_PROFILE : overrides}),
+                ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver'],
+            ):
+                profile = get_profile(LOADTEST_PROFILE)
+                urls = {
+                    name : reverse('shib_ds:{}'.format(name), kwargs={'profile' : LOADTEST_PROFILE})
+                    for name in ('search', 'redirect', 'remember-idp')
+                }
+
+                # Preparing the DiscoFeed is not part of the measurement
+                start = time.perf_counter()
+                load_test = self.get_load_test(profile, urls, LocalClient, options)
+                prepare = time.perf_counter() - start
+
+                try:
+                    with CacheCounter().patch() as counter:
+                        duration = load_test.run()
+                    stats = load_test.report(duration, counter.calls)
+                    stats['total']['prepare'] = prepare
+                finally:
+                    self.clean_up(profile, load_test, options)
+
+        return stats
+
+    def clean_up(self, profile, load_test, options):
+        """
+        Removes the selection counters of the load test and the synthetic DiscoFeed from the cache
+        """
+        flush()
+        keys = [get_counter_key(entity_id, profile) for entity_id, name in load_test.idps]
+        keys.append(get_popular_key(read_version(profile.feed_key), profile))
+        pointer = cache.get(profile.feed_key)
+        if options.get('feed_size') and isinstance(pointer, dict):
+            keys.append(profile.feed_key)
+            keys += [get_shard_key(profile.feed_key, pointer['version'], number) for number in range(pointer['shards'])]
+            keys += [
+                get_part_key(profile.feed_key, pointer['version'], part, number)
+                for part, shards in pointer.get('parts', {}).items()
+                for number in range(shards)
+            ]
+        cache.delete_many(keys)
+
+    def report(self, stats):
+        """
+        Writes the statistics as table
+        """
+        self.stdout.write("{:<14} {:>9} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9}".format(
+            'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'
+        ))
+        for endpoint, values in stats.items():
+            self.stdout.write("{:<14} {:>9} {:>7} {:>10.1f} {:>9} {:>9} {:>9} {:>9}".format(
+                endpoint,
+                values['requests'],
+                values['errors'],
+                values['throughput'],
+                *('{:.1f}'.format(values[p]) if values[p] is not None else '-' for p in ('p50', 'p90', 'p99', 'max'))
+            ))
+        total = stats['total']
+        if 'cache_calls' in total:
+            self.stdout.write("Cache round trips: {} ({:.2f} per request)".format(total['cache_calls'], total['cache_calls_per_request']))
+        else:
+            self.stdout.write("Cache round trips: unknown, the server runs in another process")
+        if 'prepare' in total:
+            self.stdout.write("Preparing the DiscoFeed took {:.3f}s and is not included".format(total['prepare']))
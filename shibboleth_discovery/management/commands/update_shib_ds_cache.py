@@ -1,9 +1,68 @@
+from concurrent.futures import ProcessPoolExecutor
+
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
 
+from shibboleth_discovery.parallel import CHUNK_SIZE
+from shibboleth_discovery.profiles import get_profile
+from shibboleth_discovery.profiles import get_profiles
 from shibboleth_discovery.utils import set_cache
 
 class Command(BaseCommand):
     help = "Updates the cache with the new data from DiscoFeed"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profile',
+            help="Update only the DiscoFeed of this profile. By default, all profiles are updated."
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help="Number of processes to prepare large DiscoFeeds in parallel. By default, everything is prepared in this process."
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=CHUNK_SIZE,
+            help="Number of IdPs or tokens a process prepares at once."
+        )
+
     def handle(self, *args, **options):
-        set_cache()
+        if options.get('profile'):
+            try:
+                profiles = [get_profile(options.get('profile'))]
+            except ValueError as e:
+                raise CommandError(str(e))
+        else:
+            profiles = get_profiles()
+
+        if options.get('workers') < 1:
+            raise CommandError("--workers must be at least 1")
+        if options.get('chunk_size') < 1:
+            raise CommandError("--chunk-size must be at least 1")
+
+        executor = ProcessPoolExecutor(options.get('workers')) if options.get('workers') > 1 else None
+
+        try:
+            # Profiles sharing a DiscoFeed share the cache, so each feed is fetched and prepared only once
+            updated = set()
+            for profile in profiles:
+                if profile.feed_key not in updated:
+                    timings = {}
+                    set_cache(profile, executor, options.get('chunk_size'), timings)
+                    updated.add(profile.feed_key)
+                    self.report(profile, timings)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def report(self, profile, timings):
+        """
+        Writes the duration of each stage
+        """
+        self.stdout.write("Updated {}".format(profile.name or 'default profile'))
+        for stage, duration in timings.items():
+            self.stdout.write("  {:<10} {:8.3f}s".format(stage, duration))
+        self.stdout.write("  {:<10} {:8.3f}s".format('total', sum(timings.values())))
@@ -1,10 +1,16 @@
+from django.http import Http404
+
+from shibboleth_discovery.profiles import get_profile_for_request
 from shibboleth_discovery.utils import get_context
 
 class ShibDSLoginMixin:
     """
     Mixin class to provide some support on the login. It does provide some information as context to use later.
+    The profile is taken from shib_ds_profile, the URL kwarg profile or the site, in this order.
     """
 
+    shib_ds_profile = None
+
     def get_context_data(self, **kwargs):
         """
         Creates a context with information:
@@ -12,6 +18,12 @@ class ShibDSLoginMixin:
             * IdPs from cookie
         """
         context = super().get_context_data(**kwargs)
-        context['shib_ds'] = get_context(self.request)
+
+        try:
+            profile = get_profile_for_request(self.request, self.shib_ds_profile or self.kwargs.get('profile'))
+        except ValueError:
+            raise Http404("Unknown profile.")
+
+        context['shib_ds'] = get_context(self.request, profile)
 
         return context
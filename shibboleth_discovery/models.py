@@ -6,15 +6,28 @@ from django.core.exceptions import ImproperlyConfigured
 
 class ShibbolethDiscoveryConf(AppConf):
 
+    CACHE_COMPRESSION = None
     CACHE_DURATION = 60*60*2 # 2 hours
+    CACHE_SHARD_SIZE = 1000*1000 # below memcached's 1 MB item limit
     COOKIE_NAME = '_saml_idp'
+    CURSOR_PARAMETER = 'cursor'
     DISCOFEED_PATH = None
     DISCOFEED_URL = None
+    FUZZY_DISTANCE = 1
+    FUZZY_SEARCH = False
+    MAX_BATCH_QUERIES = 10
     MAX_RESULTS = 10
     MAX_IDP = 3
+    POPULAR_IDPS = 5
+    POPULAR_REFRESH = 60*10 # 10 minutes
+    POPULARITY_FLUSH_INTERVAL = 60 # 1 minute
+    POPULARITY_FLUSH_SIZE = 100
     POST_PROCESSOR = lambda x: x
+    PROFILES = {}
     QUERY_PARAMETER = 'q'
     RETURN_ID_PARAM = 'entityID'
+    SITE_PROFILES = {}
+    SNAPSHOT_PATH = None
     SP_URL = ''
 
     class Meta:
@@ -32,4 +45,38 @@ if not settings.SHIB_DS_DISCOFEED_URL and not settings.SHIB_DS_DISCOFEED_PATH:
 if not settings.SHIB_DS_RETURN_ID_PARAM:
     raise ImproperlyConfigured("No returnIDParam set. Please set SHIB_DS_RETURN_ID_PARAM")
 
+# Profiles may override any option except the profiles themselves, a typo would silently fall back to the global settings
+PROFILE_OPTIONS = {option for option in vars(ShibbolethDiscoveryConf) if option.isupper()} - {'PROFILES', 'SITE_PROFILES'}
+
+# Each profile must have an SP URL and a DiscoFeed, either on its own or from the global settings
+for name, profile in settings.SHIB_DS_PROFILES.items():
+    if not isinstance(profile, dict):
+        raise ImproperlyConfigured("Profile {} in SHIB_DS_PROFILES must be a dictionary".format(name))
+    unknown = sorted(map(str, set(profile) - PROFILE_OPTIONS))
+    if unknown:
+        raise ImproperlyConfigured("Unknown options {} in profile {}".format(', '.join(unknown), name))
+    if not profile.get('SP_URL', settings.SHIB_DS_SP_URL):
+        raise ImproperlyConfigured("SP URL for redirect to IdP missing in profile {}".format(name))
+    # A profile with its own DiscoFeed does not inherit the other source, see Profile
+    own_feed = [profile[option] for option in ('DISCOFEED_URL', 'DISCOFEED_PATH') if option in profile]
+    if own_feed and not any(own_feed):
+        raise ImproperlyConfigured("No source to DiscoFeed provided in profile {}. Please set either DISCOFEED_URL or DISCOFEED_PATH".format(name))
+
+# SHIB_DS_SITE_PROFILES must point to existing profiles
+for domain, name in settings.SHIB_DS_SITE_PROFILES.items():
+    if name not in settings.SHIB_DS_PROFILES:
+        raise ImproperlyConfigured("Site {} in SHIB_DS_SITE_PROFILES points to unknown profile {}".format(domain, name))
+
+# SHIB_DS_FUZZY_DISTANCE must not be negative
+if settings.SHIB_DS_FUZZY_DISTANCE < 0:
+    raise ImproperlyConfigured("SHIB_DS_FUZZY_DISTANCE must not be negative")
+
+# SHIB_DS_CACHE_COMPRESSION must be a known codec
+if settings.SHIB_DS_CACHE_COMPRESSION not in (None, 'zlib', 'lz4', 'zstd'):
+    raise ImproperlyConfigured("Unknown compression. Please set SHIB_DS_CACHE_COMPRESSION to None, 'zlib', 'lz4' or 'zstd'")
+
+# SHIB_DS_CACHE_SHARD_SIZE must be a positive number of bytes
+if not settings.SHIB_DS_CACHE_SHARD_SIZE or settings.SHIB_DS_CACHE_SHARD_SIZE <= 0:
+    raise ImproperlyConfigured("SHIB_DS_CACHE_SHARD_SIZE must be a positive number of bytes")
+
 
@@ -0,0 +1,46 @@
+import time
+
+from contextlib import contextmanager
+
+# Number of entities or tokens a worker prepares at once
+CHUNK_SIZE = 1000
+
+
+def split(items, size):
+    """
+    Splits a list into chunks of at most size items
+    :param items: List
+    :param size: Maximum size of a chunk
+    :return: List of lists
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def map_chunks(function, items, executor=None, chunk_size=CHUNK_SIZE):
+    """
+    Applies a function to chunks of items and concatenates the results.
+    The results keep the order of the items, no matter in which order the chunks are finished.
+    This way the merged result is the same as without executor.
+    :param function: Function taking a list of items and returning a list of results, must be picklable for process pools
+    :param items: List of items
+    :param executor: concurrent.futures.Executor or None to run in the current process
+    :param chunk_size: Maximum number of items per chunk
+    :return: List of results
+    """
+    chunks = split(items, chunk_size)
+    results = executor.map(function, chunks) if executor is not None else map(function, chunks)
+
+    return [result for chunk in results for result in chunk]
+
+
+@contextmanager
+def measure(timings, stage):
+    """
+    Adds the duration of the block in seconds to timings under stage, if timings is a dictionary
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
@@ -0,0 +1,123 @@
+import hashlib
+import threading
+import time
+
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+
+from shibboleth_discovery.profiles import Profile
+
+# Selections are counted per worker and flushed to the cache in batches
+_lock = threading.Lock()
+_counts = Counter()
+_pending = 0
+_last_flush = time.monotonic()
+
+
+def get_counter_key(entity_id, profile=None):
+    """
+    Returns the cache key of the selection counter of an IdP
+    The entityID is hashed, since it may contain characters that are not allowed in cache keys
+    """
+    profile = profile or Profile()
+    return '{}:popularity:{}'.format(profile.cache_prefix, hashlib.sha1(entity_id.encode('utf-8')).hexdigest())
+
+
+def get_popular_key(version, profile=None):
+    """
+    Returns the cache key of the popular IdPs of a feed version
+    """
+    profile = profile or Profile()
+    return '{}:popular:{}'.format(profile.cache_prefix, version)
+
+
+def record_selection(entity_id, profile=None):
+    """
+    Counts the selection of an IdP in memory.
+    The counts are flushed, once SHIB_DS_POPULARITY_FLUSH_SIZE selections are pending or SHIB_DS_POPULARITY_FLUSH_INTERVAL seconds have passed
+    :param entity_id: entityID of the chosen IdP
+    :param profile: Profile, the default profile if not given
+    """
+    global _pending
+
+    profile = profile or Profile()
+
+    if not profile.POPULAR_IDPS:
+        return
+
+    with _lock:
+        _counts[(profile, entity_id)] += 1
+        _pending += 1
+        due = (
+            _pending >= settings.SHIB_DS_POPULARITY_FLUSH_SIZE
+            or time.monotonic() - _last_flush >= settings.SHIB_DS_POPULARITY_FLUSH_INTERVAL
+        )
+
+    if due:
+        flush()
+
+
+def flush():
+    """
+    Adds the counts of this worker to the counters in the cache, usually a single incr per IdP
+    """
+    global _counts, _pending, _last_flush
+
+    with _lock:
+        counts, _counts = _counts, Counter()
+        _pending = 0
+        _last_flush = time.monotonic()
+
+    for (profile, entity_id), count in counts.items():
+        key = get_counter_key(entity_id, profile)
+        try:
+            cache.incr(key, count)
+        except ValueError:
+            # The first selection or the counter was evicted, another worker may create it at the same time
+            if not cache.add(key, count, timeout=None):
+                cache.incr(key, count)
+
+
+def rank_idps(idps, profile=None):
+    """
+    Reads the counters of all IdPs with a single get_many and ranks them
+    :param idps: IdPs as prepared by prepare_data
+    :param profile: Profile, the default profile if not given
+    :return: List of positions of the SHIB_DS_POPULAR_IDPS most chosen IdPs
+    """
+    profile = profile or Profile()
+
+    if not profile.POPULAR_IDPS:
+        return []
+
+    keys = {get_counter_key(idp.get('entity_id'), profile) : position for position, idp in enumerate(idps)}
+    counts = cache.get_many(list(keys))
+
+    ranked = sorted(
+        ((count, keys[key]) for key, count in counts.items() if count > 0),
+        key=lambda x: (-x[0], x[1])
+    )
+
+    return [position for count, position in ranked[:profile.POPULAR_IDPS]]
+
+
+def get_popular(version, idps, profile=None):
+    """
+    Returns the popular IdPs of a feed version, refreshed every SHIB_DS_POPULAR_REFRESH seconds
+    :param version: Version of the prepared data
+    :param idps: IdPs as prepared by prepare_data
+    :param profile: Profile, the default profile if not given
+    :return: List of positions, most popular first
+    """
+    profile = profile or Profile()
+
+    key = get_popular_key(version, profile)
+    popular = cache.get(key)
+
+    if popular is None:
+        popular = rank_idps(idps, profile)
+        cache.set(key, popular, timeout=profile.POPULAR_REFRESH)
+
+    return popular
@@ -0,0 +1,108 @@
+import hashlib
+
+from django.conf import settings
+from django.http.request import split_domain_port
+
+# Settings that determine the prepared data. Profiles sharing them share the cached feed
+FEED_SETTINGS = ('DISCOFEED_URL', 'DISCOFEED_PATH', 'FUZZY_DISTANCE')
+
+
+class Profile:
+    """
+    Settings of a discovery profile.
+    A profile takes its settings from SHIB_DS_PROFILES and falls back to the global SHIB_DS_ settings.
+    The default profile has no name and uses only the global settings.
+    Settings are looked up on access, so changes of the settings apply immediately.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+
+    def __getattr__(self, attr):
+        overrides = settings.SHIB_DS_PROFILES.get(self.name, {}) if self.name else {}
+
+        if attr in overrides:
+            return overrides[attr]
+
+        # A profile with its own DiscoFeed must not inherit the other source of the global settings
+        if attr in ('DISCOFEED_URL', 'DISCOFEED_PATH') and ('DISCOFEED_URL' in overrides or 'DISCOFEED_PATH' in overrides):
+            return None
+
+        return getattr(settings, 'SHIB_DS_{}'.format(attr))
+
+    def __eq__(self, other):
+        return isinstance(other, Profile) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __repr__(self):
+        return 'Profile({!r})'.format(self.name)
+
+    @property
+    def cache_prefix(self):
+        """
+        Prefix for cache keys, that belong only to this profile
+        """
+        return 'shib_ds' if self.name is None else 'shib_ds:profile:{}'.format(self.name)
+
+    @property
+    def feed_key(self):
+        """
+        Cache key of the prepared feed.
+        Profiles with the same DiscoFeed share the key, so the feed is fetched and prepared only once.
+        The default DiscoFeed keeps the key shib_ds.
+        """
+        feed = tuple(getattr(self, attr) for attr in FEED_SETTINGS)
+        if feed == tuple(getattr(settings, 'SHIB_DS_{}'.format(attr)) for attr in FEED_SETTINGS):
+            return 'shib_ds'
+        return 'shib_ds:feed:{}'.format(hashlib.sha1(repr(feed).encode('utf-8')).hexdigest()[:16])
+
+    @property
+    def snapshot_path(self):
+        """
+        Path of the snapshot of the prepared feed or None.
+        Each DiscoFeed gets a file of its own next to SNAPSHOT_PATH, so profiles never load the snapshot of another feed.
+        The default DiscoFeed keeps SNAPSHOT_PATH.
+        """
+        path = self.SNAPSHOT_PATH
+        feed_key = self.feed_key
+        if not path or feed_key == 'shib_ds':
+            return path
+        return '{}.{}'.format(path, feed_key.rsplit(':', 1)[1])
+
+
+def get_profile(name=None):
+    """
+    Returns a profile by name
+    :param name: Name of a profile in SHIB_DS_PROFILES or None for the default profile
+    :return: Profile
+    :raises ValueError: If there is no such profile
+    """
+    if name is not None and name not in settings.SHIB_DS_PROFILES:
+        raise ValueError("Unknown profile {}".format(name))
+
+    return Profile(name)
+
+
+def get_profile_for_request(request, name=None):
+    """
+    Returns the profile of a request.
+    The name, e.g. from an URL kwarg, wins. Otherwise the profile is chosen by host in SHIB_DS_SITE_PROFILES.
+    :param request: Request
+    :param name: Name of a profile or None
+    :return: Profile
+    :raises ValueError: If there is no such profile
+    """
+    if name is None:
+        domain, port = split_domain_port(request.get_host())
+        name = settings.SHIB_DS_SITE_PROFILES.get(domain)
+
+    return get_profile(name)
+
+
+def get_profiles():
+    """
+    Returns the default profile and all named profiles
+    """
+    return [Profile()] + [Profile(name) for name in sorted(settings.SHIB_DS_PROFILES)]
@@ -0,0 +1,102 @@
+import threading
+
+from urllib.parse import quote_plus
+from urllib.parse import urljoin
+from urllib.parse import urlsplit
+from urllib.parse import urlunsplit
+
+from django.contrib.sites.shortcuts import get_current_site
+
+try:
+    from django.utils.http import url_has_allowed_host_and_scheme
+except ImportError:
+    # Django 2.2
+    from django.utils.http import is_safe_url as url_has_allowed_host_and_scheme
+
+from shibboleth_discovery.profiles import Profile
+
+# Hosts are limited by ALLOWED_HOSTS, but a wildcard allows any host, so the number of bases is bounded
+MAX_BASES = 100
+
+_lock = threading.Lock()
+_bases = {}
+
+
+def get_base(request, profile=None):
+    """
+    Returns the site and the pre-encoded beginning of the redirect URL for the host of a request
+    Both are resolved once per host and profile, so get_current_site is not called on each redirect
+    :param request: Request
+    :param profile: Profile, the default profile if not given
+    :return: Tuple of the domain of the site and the SP URL up to the encoded site
+    """
+    profile = profile or Profile()
+
+    # The SP settings are part of the key, so that changed settings are never served from a stale base
+    key = (request.get_host(), profile.SP_URL, profile.RETURN_ID_PARAM)
+
+    base = _bases.get(key)
+    if base is None:
+        domain = get_current_site(request).domain
+        separator = '&' if '?' in profile.SP_URL else '?'
+        base = (
+            domain,
+            '{}{}target={}'.format(profile.SP_URL, separator, quote_plus('https://{}'.format(domain))),
+            '&{}='.format(quote_plus(profile.RETURN_ID_PARAM)),
+        )
+        with _lock:
+            if len(_bases) >= MAX_BASES:
+                _bases.clear()
+            _bases[key] = base
+
+    return base
+
+
+def clear():
+    """
+    Forgets all resolved bases, e.g. after the domain of a site changed
+    """
+    with _lock:
+        _bases.clear()
+
+
+def get_target_path(request, next_url, domain):
+    """
+    Returns the path to redirect to after login
+    Only relative URLs and URLs of the site or the requested host are allowed, anything else redirects to the root of the site
+    :param request: Request
+    :param next_url: Value of the GET parameter next
+    :param domain: Domain of the site
+    :return: Absolute path, including query and fragment
+    """
+    if not next_url:
+        return '/'
+
+    # Most of the time, next is a plain path and needs no further checks
+    if next_url[0] == '/' and next_url[1:2] not in ('/', '\\') and next_url.isprintable():
+        return next_url
+
+    if not url_has_allowed_host_and_scheme(next_url, allowed_hosts={domain, request.get_host()}):
+        return '/'
+
+    scheme, netloc, path, query, fragment = urlsplit(next_url)
+
+    return urljoin('/', urlunsplit(('', '', path, query, fragment)))
+
+
+def get_redirect_url(request, entity_id, profile=None):
+    """
+    Returns the URL of the SP, that redirects to the IdP and after login to next
+    :param request: Request
+    :param entity_id: entityID of the chosen IdP
+    :param profile: Profile, the default profile if not given
+    :return: URL
+    """
+    domain, prefix, id_param = get_base(request, profile)
+
+    return ''.join((
+        prefix,
+        quote_plus(get_target_path(request, request.GET.get('next', ''), domain)),
+        id_param,
+        quote_plus(entity_id),
+    ))
@@ -0,0 +1,322 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+
+# Increase, whenever the structure of the snapshot file changes
+SNAPSHOT_FORMAT = 1
+
+
+class CacheWriteError(Exception):
+    """
+    Raised if the cache did not store all shards of the prepared data
+    """
+
+
+def get_codec(name):
+    """
+    Returns the compress and decompress functions for a codec
+    lz4 and zstd are optional dependencies and only imported if requested
+    :param name: None, 'zlib', 'lz4' or 'zstd'
+    :return: Tuple of compress and decompress function
+    """
+    if name is None:
+        return (lambda blob: blob, lambda blob: blob)
+
+    if name == 'zlib':
+        return (zlib.compress, zlib.decompress)
+
+    if name == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImproperlyConfigured("SHIB_DS_CACHE_COMPRESSION 'lz4' requires the package lz4")
+        return (lz4.frame.compress, lz4.frame.decompress)
+
+    if name == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImproperlyConfigured("SHIB_DS_CACHE_COMPRESSION 'zstd' requires the package zstandard")
+        return (zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress)
+
+    raise ImproperlyConfigured("Unknown SHIB_DS_CACHE_COMPRESSION '{}'".format(name))
+
+
+def get_shard_key(key, version, number):
+    """
+    Returns the cache key of a single shard
+    """
+    return '{}:{}:{}'.format(key, version, number)
+
+
+def encode(data, codec):
+    """
+    Pickles and compresses data
+    :param data: Any picklable object
+    :param codec: Name of the codec, see get_codec
+    :return: Tuple of version derived from the content and compressed bytes
+    """
+    compress, decompress = get_codec(codec)
+
+    raw = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return get_version(raw), compress(raw)
+
+
+def get_version(raw):
+    """
+    Returns the version of pickled data, it does not depend on the codec
+    """
+    return hashlib.sha1(raw).hexdigest()[:16]
+
+
+def decode(blob, codec):
+    """
+    Decompresses and unpickles data, as encoded by encode
+    """
+    compress, decompress = get_codec(codec)
+
+    return pickle.loads(decompress(blob))
+
+
+class PreparedData(dict):
+    """
+    Prepared data, whose lazy parts are only read from the cache on first access
+    Compared and pickled, it behaves like a dictionary with all parts
+    """
+
+    def __init__(self, data, loader, parts):
+        super().__init__(data)
+        self.loader = loader
+        self.parts = parts
+
+    def __missing__(self, name):
+        if name not in self.parts:
+            raise KeyError(name)
+        value = self.loader(name)
+        self[name] = value
+        return value
+
+    def load_all(self):
+        """
+        Returns a dictionary with all parts
+        """
+        return {**self, **{part : self[part] for part in self.parts}}
+
+    def __eq__(self, other):
+        return self.load_all() == (other.load_all() if isinstance(other, PreparedData) else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return (dict, (self.load_all(),))
+
+
+def get_part_key(key, version, part, number):
+    """
+    Returns the cache key of a single shard of a lazy part
+    """
+    return get_shard_key(key, version, '{}-{}'.format(part, number))
+
+
+def split_shards(blob):
+    """
+    Splits a blob into shards of at most SHIB_DS_CACHE_SHARD_SIZE bytes
+    """
+    size = settings.SHIB_DS_CACHE_SHARD_SIZE
+    return [blob[i:i + size] for i in range(0, len(blob), size)] or [blob]
+
+
+def write_prepared(key, data, timeout, lazy=()):
+    """
+    Stores prepared data in the cache.
+    The strategy is the following:
+    The data is pickled, compressed and split into shards of at most SHIB_DS_CACHE_SHARD_SIZE bytes.
+    The shards are stored under a version derived from the content.
+    Only after all shards are written, the pointer under key is flipped to the new version.
+    This way readers never see a half written feed.
+    Lazy parts of a dictionary, e.g. indexes that only some requests need, are stored in shards of their own.
+    :param key: Cache key of the pointer
+    :param data: Any picklable object
+    :param timeout: Cache timeout
+    :param lazy: Keys of data, that are only read when accessed, see read_prepared
+    :return: Version of the stored data
+    :raises CacheWriteError: If the cache rejected a shard, the pointer is left unchanged then
+    """
+    codec = settings.SHIB_DS_CACHE_COMPRESSION
+    lazy = [part for part in lazy if part in data]
+
+    if lazy:
+        # The version covers all parts, so it does not depend on which parts are lazy
+        # Only the pickle is hashed, compressing is left to the blobs, that are actually stored
+        version = get_version(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+        parts = {part : encode(data[part], codec)[1] for part in lazy}
+        blob = encode({name : value for name, value in data.items() if name not in lazy}, codec)[1]
+    else:
+        version, blob = encode(data, codec)
+        parts = {}
+
+    shards = split_shards(blob)
+    part_shards = {part : split_shards(part_blob) for part, part_blob in parts.items()}
+
+    entries = {get_shard_key(key, version, number) : shard for number, shard in enumerate(shards)}
+    for part, shards_of_part in part_shards.items():
+        entries.update({get_part_key(key, version, part, number) : shard for number, shard in enumerate(shards_of_part)})
+
+    # Memcached returns the keys it failed to store, a pointer to them would make every reader miss
+    failed = cache.set_many(entries, timeout=timeout)
+    if failed:
+        cache.delete_many(list(entries))
+        raise CacheWriteError("Could not store {} of {} shards of {} in the cache".format(len(failed), len(entries), key))
+    cache.set(
+        key,
+        {
+            'version' : version,
+            'codec' : codec,
+            'shards' : len(shards),
+            'parts' : {part : len(shards_of_part) for part, shards_of_part in part_shards.items()},
+        },
+        timeout=timeout
+    )
+
+    return version
+
+
+def read_version(key):
+    """
+    Returns the version of the prepared data in the cache without fetching the shards
+    :param key: Cache key of the pointer
+    :return: Version or None if not cached
+    """
+    pointer = cache.get(key)
+    if not isinstance(pointer, dict):
+        return None
+
+    return pointer['version']
+
+
+def read_part(key, pointer, part):
+    """
+    Reads a lazy part of the prepared data, as stored by write_prepared
+    :param key: Cache key of the pointer
+    :param pointer: Pointer of the version the part belongs to
+    :param part: Name of the part
+    :return: Value of the part or None if it is not cached or incomplete
+    """
+    keys = [get_part_key(key, pointer['version'], part, number) for number in range(pointer['parts'][part])]
+    shards = cache.get_many(keys)
+    if len(shards) != len(keys):
+        return None
+
+    return decode(b''.join(shards[k] for k in keys), pointer['codec'])
+
+
+def read_prepared(key, fallback=None):
+    """
+    Reads prepared data from the cache, as stored by write_prepared
+    All shards are fetched with a single get_many, lazy parts are fetched on first access
+    :param key: Cache key of the pointer
+    :param fallback: Function taking the name of a lazy part and the data, that rebuilds the part if it was evicted
+    :return: Tuple of version and data or (None, None) if not cached or incomplete
+    """
+    pointer = cache.get(key)
+    # Anything else than a pointer, e.g. an entry of an older layout, counts as a miss
+    if not isinstance(pointer, dict):
+        return (None, None)
+
+    keys = [get_shard_key(key, pointer['version'], number) for number in range(pointer['shards'])]
+    shards = cache.get_many(keys)
+    # A single evicted shard invalidates the whole version
+    if len(shards) != len(keys):
+        return (None, None)
+
+    data = decode(b''.join(shards[k] for k in keys), pointer['codec'])
+
+    if not pointer.get('parts'):
+        return (pointer['version'], data)
+
+    def load(part):
+        value = read_part(key, pointer, part)
+        if value is None:
+            if fallback is None:
+                raise KeyError(part)
+            value = fallback(part, data)
+        return value
+
+    return (pointer['version'], PreparedData(data, load, tuple(pointer['parts'])))
+
+
+def write_snapshot(path, data):
+    """
+    Stores prepared data in a file, so that it survives a cleared cache and an unreachable DiscoFeed.
+    The file is written next to the target and then renamed, so readers never see a half written snapshot.
+    :param path: Path of the snapshot file
+    :param data: Any picklable object
+    :return: Version of the stored data
+    :raises OSError: If the file cannot be written
+    """
+    # A snapshot should be compact, even if the cache is not compressed
+    codec = settings.SHIB_DS_CACHE_COMPRESSION or 'zlib'
+    version, blob = encode(data, codec)
+
+    directory, filename = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=filename, dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            pickle.dump(
+                {
+                    'format' : SNAPSHOT_FORMAT,
+                    'version' : version,
+                    'codec' : codec,
+                    'data' : blob,
+                },
+                fout,
+                protocol=pickle.HIGHEST_PROTOCOL
+            )
+        # mkstemp creates files only readable by the owner, but the DiscoFeed is public anyway
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return version
+
+
+def read_snapshot(path):
+    """
+    Reads prepared data from a file, as stored by write_snapshot
+    :param path: Path of the snapshot file
+    :return: Tuple of version and data or (None, None) if there is no usable snapshot
+    """
+    try:
+        with open(path, 'rb') as fin:
+            snapshot = pickle.load(fin)
+        if snapshot.get('format') != SNAPSHOT_FORMAT:
+            return (None, None)
+        return (snapshot['version'], decode(snapshot['data'], snapshot['codec']))
+    except Exception:
+        # Missing, unreadable or corrupt snapshots are treated like no snapshot at all
+        return (None, None)
+
+
+def get_snapshot_age(path):
+    """
+    Returns the time since a snapshot was written
+    :param path: Path of the snapshot file
+    :return: Age in seconds or None if there is no snapshot
+    """
+    try:
+        return time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
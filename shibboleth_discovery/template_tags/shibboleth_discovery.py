@@ -1,16 +1,51 @@
 from django import template
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 
+from shibboleth_discovery.profiles import get_profile_for_request
 from shibboleth_discovery.utils import get_context
+from shibboleth_discovery.utils import get_fragment_key
+from shibboleth_discovery.utils import get_recent_idps
 
 register = template.Library()
 
 @register.simple_tag(takes_context=True)
-def shib_ds_context(context):
+def shib_ds_context(context, profile=None):
     """
     Creates a dictionary with information:
         * ServiceProvider login handler
         * IdPs from cookie
+    The profile is chosen by name or by the site of the request
     """
-    shib_ds = get_context(context.request)
+    shib_ds = get_context(context.request, get_profile_for_request(context.request, profile))
 
     return shib_ds
+
+@register.simple_tag(takes_context=True)
+def shib_ds_recent_idps(context, profile=None, template_name='shibboleth_discovery/recent_idps.html'):
+    """
+    Renders the recent IdPs from cookie like an inclusion tag and caches the HTML
+    The fragment is cached by cookie, language and version of the prepared data, so it is rendered only once per combination
+    The template gets only recent_idps, return_id_param, sp_url and profile, anything else would not be covered by the cache key
+    The IdPs are localized, but not post processed, so templates can rely on entity_id and name
+    """
+    request = context.request
+    profile = get_profile_for_request(request, profile)
+
+    key = get_fragment_key(request, template_name, profile)
+    fragment = cache.get(key)
+
+    if fragment is None:
+        fragment = render_to_string(
+            template_name,
+            {
+                'recent_idps' : get_recent_idps(request, profile, post_process=False),
+                'return_id_param' : profile.RETURN_ID_PARAM,
+                'sp_url' : profile.SP_URL,
+                'profile' : profile.name,
+            }
+        )
+        cache.set(key, fragment, timeout=profile.CACHE_DURATION)
+
+    return mark_safe(fragment)
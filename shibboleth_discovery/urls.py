@@ -5,7 +5,15 @@ from . import views
 app_name = 'shib_ds'
 
 urlpatterns = [
+    path('batch-search/', views.BatchSearchView.as_view(), name='batch-search'),
+    path('lookup/', views.DomainLookupView.as_view(), name='lookup'),
     path('redirect/', views.RedirectView.as_view(), name='redirect'),
     path('search/', views.SearchView.as_view(), name='search'),
     path('set_idp_cookie/', views.SetCookieView.as_view(), name='remember-idp'),
+    # The same views for a named profile, see SHIB_DS_PROFILES
+    path('<str:profile>/batch-search/', views.BatchSearchView.as_view(), name='batch-search'),
+    path('<str:profile>/lookup/', views.DomainLookupView.as_view(), name='lookup'),
+    path('<str:profile>/redirect/', views.RedirectView.as_view(), name='redirect'),
+    path('<str:profile>/search/', views.SearchView.as_view(), name='search'),
+    path('<str:profile>/set_idp_cookie/', views.SetCookieView.as_view(), name='remember-idp'),
 ]
@@ -1,14 +1,50 @@
+import hashlib
 import json
 import requests
 
 from base64 import b64decode, b64encode
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
 from datetime import datetime
 from datetime import timedelta
+from functools import partial
+from itertools import islice
 
-from django.conf import settings
-from django.core.cache import cache
 from django.utils import translation
 
+from shibboleth_discovery.coalesce import SingleFlight
+from shibboleth_discovery.domains import build_domain_index
+from shibboleth_discovery.domains import lookup as lookup_domain
+from shibboleth_discovery.fuzzy import build_fuzzy_index
+from shibboleth_discovery.fuzzy import lookup
+from shibboleth_discovery.parallel import CHUNK_SIZE
+from shibboleth_discovery.parallel import map_chunks
+from shibboleth_discovery.parallel import measure
+from shibboleth_discovery.popularity import get_popular
+from shibboleth_discovery.profiles import Profile
+from shibboleth_discovery.profiles import get_profile_for_request
+from shibboleth_discovery.storage import get_snapshot_age
+from shibboleth_discovery.storage import read_prepared
+from shibboleth_discovery.storage import read_version
+from shibboleth_discovery.storage import read_snapshot
+from shibboleth_discovery.storage import write_prepared
+from shibboleth_discovery.storage import write_snapshot
+
+# Concurrent loads of the prepared data on a cache miss
+_loads = SingleFlight()
+
+ENTITY_CATEGORY = 'http://macedir.org/entity-category'
+
+# Indexes that only some requests need, they are stored apart and only read from the cache when used
+LAZY_INDEXES = ('fuzzy', 'domains')
+
+# Facets that can be used to filter IdPs, each one with a function returning the values of an IdP
+FACETS = {
+    'registration_authority' : lambda idp: [idp['registration_authority']] if idp.get('registration_authority') else [],
+    'entity_category' : lambda idp: idp.get('entity_categories', []),
+    'domain_hint' : lambda idp: idp.get('domain_hints', []),
+}
+
 def b64decode_idp(idp):
     """
     Decodes an idp from base64 to string
@@ -53,16 +89,19 @@ def get_feed_by_path(path):
         raise Exception("Could not read file or received invalid JSON")
 
 
-def get_feed():
+def get_feed(profile=None):
     """
     This fetches the feed, either from a file or a remote
+    :param profile: Profile, the default profile if not given
     :return: DiscoFeed as python object
     """
-    if settings.SHIB_DS_DISCOFEED_URL:
-        return get_feed_by_url(settings.SHIB_DS_DISCOFEED_URL)
+    profile = profile or Profile()
+
+    if profile.DISCOFEED_URL:
+        return get_feed_by_url(profile.DISCOFEED_URL)
 
-    if settings.SHIB_DS_DISCOFEED_PATH:
-        return get_feed_by_path(settings.SHIB_DS_DISCOFEED_PATH)
+    if profile.DISCOFEED_PATH:
+        return get_feed_by_path(profile.DISCOFEED_PATH)
 
 
 def get_largest_logo(logos):
@@ -76,19 +115,23 @@ def get_largest_logo(logos):
         return logo
 
 
-def prepare_data():
+def get_entity_attribute(attributes, name):
     """
-    This function prepares the data.
-    The strategy is the following:
-    We assign to each IdP a unique id (integer).
-    Then we create two lists
-    The first one containes structered informationen about the IdP (entityId, name, logo)
-    The second one is for easyily finding matches
-    :return: Tuple containing the DiscoFeed and list of names
+    Given a list of entity attributes, this one collects the values of all attributes with the name
+    :param attributes: List of entity attributes
+    :param name: Name of the attribute
+    :return: List of values
     """
-    feed = get_feed()
+    return [value for attribute in attributes if attribute.get('name') == name for value in attribute.get('values', [])]
 
-    idps = [
+
+def prepare_idps(feed):
+    """
+    Prepares the IdPs of a DiscoFeed or a chunk of it
+    :param feed: List of IdPs as in the DiscoFeed
+    :return: List of IdPs
+    """
+    return [
         {
             'entity_id' : idp.get('entityID'),
             'name' : {
@@ -97,34 +140,271 @@ def prepare_data():
             'description' : {
                 entry.get('lang'):entry.get('value') for entry in idp.get('Descriptions', [])
             },
-            'logo' : get_largest_logo(idp.get('Logos', []))
-
+            'logo' : get_largest_logo(idp.get('Logos', [])),
+            'information_url' : {
+                entry.get('lang'):entry.get('value') for entry in idp.get('InformationURLs', [])
+            },
+            'privacy_statement_url' : {
+                entry.get('lang'):entry.get('value') for entry in idp.get('PrivacyStatementURLs', [])
+            },
+            'registration_authority' : idp.get('RegistrationAuthority'),
+            'entity_categories' : get_entity_attribute(idp.get('EntityAttributes', []), ENTITY_CATEGORY),
+            'domain_hints' : idp.get('DomainHints', []),
+            'scopes' : idp.get('Scopes', []),
         }
         for idp in feed
     ]
 
-    index = [' '.join(idp.get('name', {}).values()).strip().lower() for idp in idps]
+
+def prepare_data(profile=None, executor=None, chunk_size=CHUNK_SIZE, timings=None):
+    """
+    This function prepares the data.
+    The strategy is the following:
+    We assign to each IdP a unique id (integer).
+    Then we create two lists
+    The first one containes structered informationen about the IdP (entityId, name, logo, ...)
+    The second one is for easyily finding matches
+    :param profile: Profile, the default profile if not given
+    :param executor: Executor to prepare chunks of the DiscoFeed in parallel, see map_chunks
+    :param chunk_size: Number of IdPs per chunk
+    :param timings: Dictionary to add the duration of each stage to or None
+    :return: Tuple containing the DiscoFeed and list of names
+    """
+    with measure(timings, 'fetch'):
+        feed = get_feed(profile)
+
+    with measure(timings, 'idps'):
+        idps = map_chunks(prepare_idps, feed, executor, chunk_size)
+        index = [' '.join(idp.get('name', {}).values()).strip().lower() for idp in idps]
 
     return (idps, index)
 
 
+def to_bitset(positions):
+    """
+    Creates a bitset as integer, where the bit of each position is set
+    :param positions: Iterable of positions
+    :return: Integer
+    """
+    positions = list(positions)
+    if not positions:
+        return 0
+    bits = bytearray(max(positions) // 8 + 1)
+    for position in positions:
+        bits[position // 8] |= 1 << (position % 8)
+    return int.from_bytes(bits, 'little')
+
+
+def iter_bitset(bitset, start=0):
+    """
+    Yields the positions of all set bits, beginning at a position
+    :param bitset: Integer
+    :param start: First position
+    :return: Generator of positions
+    """
+    bitset >>= start
+    while bitset:
+        lowest = bitset & -bitset
+        yield start + lowest.bit_length() - 1
+        bitset ^= lowest
+
+
+def build_facets(idps):
+    """
+    Indexes the facets of the IdPs.
+    For each facet and each value we store a bitset of the IdPs having this value
+    :param idps: IdPs as prepared by prepare_data
+    :return: Dictionary of facets, containing dictionaries of values and bitsets
+    """
+    facets = {}
+    for facet, get_values in FACETS.items():
+        positions = {}
+        for position, idp in enumerate(idps):
+            for value in get_values(idp):
+                positions.setdefault(value, []).append(position)
+        facets[facet] = {value : to_bitset(value_positions) for value, value_positions in positions.items()}
+
+    return facets
+
+
+def check_facets(facets):
+    """
+    Checks the names of facet filters without loading the prepared data
+    :param facets: Dictionary of facets and lists of values
+    :raises ValueError: If a facet is unknown
+    """
+    for facet in facets or {}:
+        if facet not in FACETS:
+            raise ValueError("Unknown facet {}".format(facet))
+
+
+def get_facet_mask(facets, data):
+    """
+    Combines facet filters to a single bitset.
+    Values of one facet are combined with OR, different facets with AND
+    :param facets: Dictionary of facets and lists of values
+    :param data: Prepared data as returned by get_or_set_prepared
+    :return: Bitset or None if nothing is filtered
+    :raises ValueError: If a facet is unknown
+    """
+    check_facets(facets)
+
+    mask = None
+    for facet, values in (facets or {}).items():
+        values = [value for value in values if value]
+        if not values:
+            continue
+        facet_mask = 0
+        for value in values:
+            facet_mask |= data['facets'][facet].get(value, 0)
+        mask = facet_mask if mask is None else mask & facet_mask
+
+    return mask
+
+
+def build_index(name, data, profile=None):
+    """
+    Builds a lazy index from the IdPs and the index, e.g. if it was evicted from the cache
+    :param name: 'fuzzy' or 'domains'
+    :param data: Prepared data
+    :param profile: Profile, the default profile if not given
+    """
+    profile = profile or Profile()
+
+    if name == 'fuzzy':
+        return build_fuzzy_index(data['index'], profile.FUZZY_DISTANCE)
+    if name == 'domains':
+        return build_domain_index(data['idps'])
+
+    raise KeyError(name)
+
+
+def prepare_feed(profile=None, executor=None, chunk_size=CHUNK_SIZE, timings=None):
+    """
+    Prepares the data and builds the indexes, this is what is cached
+    With an executor, the IdPs and the fuzzy index are prepared in chunks and merged in order, so the result is the same
+    :param profile: Profile, the default profile if not given
+    :param executor: concurrent.futures.Executor or None to prepare everything in the current process
+    :param chunk_size: Number of IdPs or tokens per chunk
+    :param timings: Dictionary to add the duration of each stage to or None
+    :return: Dictionary containing idps, index, facets, fuzzy index and domain index
+    """
+    profile = profile or Profile()
+    idps, index = prepare_data(profile, executor, chunk_size, timings)
+
+    with measure(timings, 'facets'):
+        facets = build_facets(idps)
+
+    with measure(timings, 'fuzzy'):
+        fuzzy = build_fuzzy_index(index, profile.FUZZY_DISTANCE, executor, chunk_size)
+
+    with measure(timings, 'domains'):
+        domains = build_domain_index(idps)
+
+    return {
+        'idps' : idps,
+        'index' : index,
+        'facets' : facets,
+        'fuzzy' : fuzzy,
+        'domains' : domains,
+    }
+
+
+def localize_url(urls, language):
+    """
+    Returns the localized URL, falls back to English and then to any language
+    """
+    return urls.get(language) or urls.get('en') or next(iter(urls.values()), None)
+
+
 def localize_idp(idp):
     """
     Localizes a given IdP, e.g. try to set a locale string. Else English string is used
+    The IdP is copied, so that the prepared data can be reused for several searches
     :param idp: IdP as prepared by prepare_data
     :return: IdP with local names
     """
     language = translation.get_language()
+    idp = dict(idp)
     idp['name'] = idp.get('name', {}).get(language, idp.get('name', {}).get('en', ''))
     idp['description'] = idp.get('description', {}).get(language, idp.get('description', {}).get('en', ''))
+    idp['information_url'] = localize_url(idp.get('information_url', {}), language)
+    idp['privacy_statement_url'] = localize_url(idp.get('privacy_statement_url', {}), language)
     return idp
 
 
-def search(tokens):
+def tokenize(query):
+    """
+    Splits a query into search tokens
+    As search tokens, we allow only non-empty strings
+    :param query: Search query
+    :return: list of tokens
+    """
+    return [t for t in query.split(' ') if t.strip()]
+
+
+def iter_matches(tokens, data, start=0, mask=None, fuzzy=False, boost=()):
+    """
+    Walks through the index, beginning at a position, and yields the matching IdPs
+    Exact matches of boosted IdPs come first, then the other exact matches.
+    In fuzzy mode, they are followed by IdPs where each token matches exactly or with a typo.
+    Positions are shifted by the number of boosted IdPs and for fuzzy matches also by the size of the index,
+    so that a single position describes the stream.
+    :param tokens: list of lower case tokens
+    :param data: Prepared data as returned by get_or_set_prepared
+    :param start: Position in the stream to resume from
+    :param mask: Bitset of allowed positions or None
+    :param fuzzy: Whether to yield fuzzy matches
+    :param boost: List of positions of IdPs to rank first, e.g. popular ones
+    :return: Generator of tuples of position and IdP
+    """
+    idps, index = data['idps'], data['index']
+    size = len(index)
+    offset = len(boost)
+    boosted = set(boost)
+
+    for rank in range(start, offset):
+        position = boost[rank]
+        if mask is not None and not mask >> position & 1:
+            continue
+        if all(token in index[position] for token in tokens):
+            yield rank, idps[position]
+
+    start = max(start - offset, 0)
+    positions = range(start, size) if mask is None else iter_bitset(mask, start)
+    for position in positions:
+        if position >= size:
+            break
+        if position not in boosted and all(token in index[position] for token in tokens):
+            yield offset + position, idps[position]
+
+    if not fuzzy:
+        return
+
+    similar = [lookup(token, data['fuzzy']) for token in tokens]
+    for position in sorted(set().union(*similar)):
+        if size + position < start or (mask is not None and not mask >> position & 1):
+            continue
+        entry = index[position]
+        # Exact matches have already been yielded
+        if all(token in entry for token in tokens):
+            continue
+        if all(token in entry or position in token_positions for token, token_positions in zip(tokens, similar)):
+            yield offset + size + position, idps[position]
+
+
+def search(tokens, data=None, limit=None, facets=None, fuzzy=False, boost=(), profile=None):
     """
     Searches in the cached index after the tokens and returns the localized result
     :param tokens: list of token (empty token matches)
+    :param data: Prepared data as returned by get_or_set_prepared, loaded if not given
+    :param limit: Maximum number of results, only these are localized
+    :param facets: Dictionary of facets and lists of values to filter the IdPs
+    :param fuzzy: Whether to append matches with typos
+    :param boost: List of positions of IdPs to rank first, the popular IdPs if data is not given
+    :param profile: Profile to load the data for, the default profile if not given
     :return: list of entityIds
+    :raises ValueError: If a facet is unknown
     """
     # No token shall lead to no result
     if not tokens:
@@ -132,48 +412,179 @@ def search(tokens):
 
     tokens = [token.lower().strip() for token in tokens]
 
-    idps, index = get_or_set_cache()
+    if data is None:
+        version, data = get_or_set_prepared(profile)
+        boost = get_popular(version, data['idps'], profile)
+
+    matches = iter_matches(tokens, data, mask=get_facet_mask(facets, data), fuzzy=fuzzy, boost=boost)
 
-    result = [localize_idp(idp) for idp, idx in zip(idps, index) if all(token in idx for token in tokens)]
+    result = [localize_idp(idp) for position, idp in islice(matches, limit)]
 
     return result
 
 
-def get_recent_idps(request):
+def search_domain(query, data=None, limit=None, profile=None, facets=None):
+    """
+    Finds the IdPs of a domain or email address and returns the localized result
+    :param query: Domain or email address, e.g. user@tu-darmstadt.de
+    :param data: Prepared data as returned by get_or_set_prepared, loaded if not given
+    :param limit: Maximum number of results
+    :param profile: Profile to load the data for, the default profile if not given
+    :param facets: Dictionary of facets and lists of values, see get_facet_mask
+    :return: list of IdPs
+    :raises ValueError: If a facet is unknown
+    """
+    if data is None:
+        version, data = get_or_set_prepared(profile)
+
+    positions = lookup_domain(query, data['domains'])
+
+    mask = get_facet_mask(facets, data)
+    if mask is not None:
+        positions = [position for position in positions if mask >> position & 1]
+
+    return [localize_idp(data['idps'][position]) for position in positions[:limit]]
+
+
+def encode_cursor(version, position, boost=()):
+    """
+    Creates an opaque cursor for a position in the match stream of a feed version
+    The boosted IdPs are frozen in the cursor, so that later pages keep the order of the first one
+    """
+    return str(urlsafe_b64encode('{}:{}:{}'.format(version, position, ','.join(map(str, boost))).encode('utf-8')), 'utf-8')
+
+
+def decode_cursor(cursor, version):
+    """
+    Returns the position and the boosted IdPs stored in a cursor
+    :param cursor: Cursor as created by encode_cursor
+    :param version: Version of the current feed
+    :return: Tuple of position in the match stream and list of positions of boosted IdPs
+    :raises ValueError: If the cursor is invalid or belongs to another feed version
+    """
+    try:
+        cursor_version, position, boost = str(urlsafe_b64decode(cursor.encode('utf-8')), 'utf-8').split(':')
+        position = int(position)
+        boost = [int(boosted) for boosted in boost.split(',') if boosted]
+    except (TypeError, ValueError, BinasciiError):
+        raise ValueError("Invalid cursor")
+
+    if cursor_version != version or position < 0 or any(boosted < 0 for boosted in boost):
+        raise ValueError("Cursor expired")
+
+    return position, boost
+
+
+def search_page(tokens, limit, cursor=None, facets=None, fuzzy=False, profile=None):
+    """
+    Searches like search, but returns a single page and a cursor for the next one
+    The next page resumes at the cursor position instead of searching from the start
+    Popular IdPs are ranked first, the next pages keep the popular IdPs of the first page, even if they were refreshed meanwhile
+    :param tokens: list of token
+    :param limit: Page size
+    :param cursor: Cursor as returned for the previous page or None for the first page
+    :param facets: Dictionary of facets and lists of values to filter the IdPs
+    :param fuzzy: Whether to append matches with typos
+    :param profile: Profile, the default profile if not given
+    :return: Tuple of list of IdPs and cursor, which is None on the last page
+    :raises ValueError: If the cursor is invalid or expired or a facet is unknown
+    """
+    # An empty query matches nothing, so the prepared data is not even loaded
+    if not tokens:
+        check_facets(facets)
+        return [], None
+
+    version, data = get_or_set_prepared(profile)
+
+    if cursor:
+        start, boost = decode_cursor(cursor, version)
+        if any(boosted >= len(data['idps']) for boosted in boost):
+            raise ValueError("Invalid cursor")
+    else:
+        start, boost = 0, get_popular(version, data['idps'], profile)
+
+    mask = get_facet_mask(facets, data)
+
+    tokens = [token.lower().strip() for token in tokens]
+
+    # We take one more match to know where the next page starts
+    matches = list(islice(iter_matches(tokens, data, start, mask, fuzzy, boost), limit + 1))
+
+    next_cursor = encode_cursor(version, matches[limit][0], boost) if len(matches) > limit else None
+
+    return [localize_idp(idp) for position, idp in matches[:limit]], next_cursor
+
+
+def get_recent_idps(request, profile=None, prepared=None, post_process=True):
     """
     Returns a list of recent IdPs formatted by SHIB_DS_POST_PROCESSOR
+    :param request: Request
+    :param profile: Profile, the default profile if not given
+    :param prepared: Tuple of version and prepared data, loaded if not given
+    :param post_process: Whether to apply SHIB_DS_POST_PROCESSOR, otherwise the IdPs are only localized
     """
-    saved_idps = [b64decode_idp(idp) for idp in request.COOKIES.get(settings.SHIB_DS_COOKIE_NAME, '').split(' ') if idp]
+    profile = profile or Profile()
 
-    idps, index = get_or_set_cache()
+    saved_idps = [b64decode_idp(idp) for idp in request.COOKIES.get(profile.COOKIE_NAME, '').split(' ') if idp]
 
-    recent_idps = settings.SHIB_DS_POST_PROCESSOR(
+    version, data = prepared or get_or_set_prepared(profile)
+
+    recent_idps = [
+        localize_idp(idp) for idp in data['idps']
+        if any(saved_idp == idp.get('entity_id') for saved_idp in saved_idps)
+    ]
+    if post_process:
+        recent_idps = profile.POST_PROCESSOR(recent_idps)
+    return recent_idps
+
+
+def get_popular_idps(profile=None, prepared=None):
+    """
+    Returns a list of the most chosen IdPs formatted by SHIB_DS_POST_PROCESSOR
+    :param profile: Profile, the default profile if not given
+    :param prepared: Tuple of version and prepared data, loaded if not given
+    """
+    profile = profile or Profile()
+
+    version, data = prepared or get_or_set_prepared(profile)
+
+    popular_idps = profile.POST_PROCESSOR(
         [
-            localize_idp(idp) for idp in idps
-            if any(saved_idp == idp.get('entity_id') for saved_idp in saved_idps)
+            localize_idp(data['idps'][position]) for position in get_popular(version, data['idps'], profile)
         ]
     )
-    return recent_idps
+    return popular_idps
 
 
-def get_context(request):
+def get_context(request, profile=None):
     """
     Takes a request and returns a dictionary containing some information for context
+    The prepared data is loaded once for the recent and the popular IdPs
+    :param request: Request
+    :param profile: Profile, chosen by the site of the request if not given
     """
+    profile = profile or get_profile_for_request(request)
+
+    prepared = get_or_set_prepared(profile)
+
     shib_ds = {
-        'recent_idps' : get_recent_idps(request),
-        'return_id_param' : settings.SHIB_DS_RETURN_ID_PARAM,
-        'sp_url' : settings.SHIB_DS_SP_URL,
+        'profile' : profile.name,
+        'recent_idps' : get_recent_idps(request, profile, prepared),
+        'popular_idps' : get_popular_idps(profile, prepared),
+        'return_id_param' : profile.RETURN_ID_PARAM,
+        'sp_url' : profile.SP_URL,
         'next' : request.GET.get('next', ''),
     }
     return shib_ds
 
 
-def set_cookie(response, request, entity_id):
+def set_cookie(response, request, entity_id, profile=None):
     """
     Adds a cookie to the given response
     """
-    idps = [b64decode_idp(idp) for idp in request.COOKIES.get(settings.SHIB_DS_COOKIE_NAME, '').split(' ') if idp]
+    profile = profile or Profile()
+
+    idps = [b64decode_idp(idp) for idp in request.COOKIES.get(profile.COOKIE_NAME, '').split(' ') if idp]
     # We delete the entity_id / IdP from the list and then append the list to our new entity id.
     # This way, the new entity id is the first
     try:
@@ -184,30 +595,142 @@ def set_cookie(response, request, entity_id):
     idps = [b64encode_idp(idp) for idp in [entity_id] + idps]
 
     response.set_cookie(
-        settings.SHIB_DS_COOKIE_NAME,
-        value=' '.join(idps[:settings.SHIB_DS_MAX_IDP]),
+        profile.COOKIE_NAME,
+        value=' '.join(idps[:profile.MAX_IDP]),
         expires=datetime.now() + timedelta(days=365),
     )
 
-def set_cache():
+def set_cache(profile=None, executor=None, chunk_size=CHUNK_SIZE, timings=None):
     """
     This is a shortcut that includes shibboleth discovery specific parameters
+    If SHIB_DS_SNAPSHOT_PATH is set, the prepared data is stored there as well
+    :param profile: Profile, the default profile if not given
+    :param executor: Executor to prepare the data in parallel, see prepare_feed
+    :param chunk_size: Number of IdPs or tokens per chunk
+    :param timings: Dictionary to add the duration of each stage to or None
+    """
+    profile = profile or Profile()
+
+    data = prepare_feed(profile, executor, chunk_size, timings)
+
+    with measure(timings, 'cache'):
+        write_prepared(
+            profile.feed_key,
+            data,
+            timeout=profile.CACHE_DURATION,
+            lazy=LAZY_INDEXES
+        )
+
+    if profile.snapshot_path:
+        with measure(timings, 'snapshot'):
+            write_snapshot(profile.snapshot_path, data)
+
+def load_prepared(profile):
+    """
+    Loads the prepared data on a cache miss from the snapshot or the DiscoFeed and caches it
+    A snapshot younger than SHIB_DS_CACHE_DURATION is used as is, an older one only if the DiscoFeed cannot be fetched
+    :param profile: Profile
+    :return: Tuple of version and prepared data, see prepare_feed
     """
-    cache.set(
-        'shib_ds',
-        prepare_data(),
-        timeout=settings.SHIB_DS_CACHE_DURATION
+    # Another worker may have filled the cache in the meantime
+    version, data = read_prepared(profile.feed_key, partial(build_index, profile=profile))
+    if data is not None:
+        return version, data
+
+    snapshot = (None, None)
+    if profile.snapshot_path:
+        snapshot = read_snapshot(profile.snapshot_path)
+        age = get_snapshot_age(profile.snapshot_path)
+        if snapshot[1] is not None and (profile.CACHE_DURATION is None or age < profile.CACHE_DURATION):
+            version, data = snapshot
+
+    if data is None:
+        try:
+            data = prepare_feed(profile)
+        except Exception:
+            # An outdated snapshot is better than no login at all
+            if snapshot[1] is None:
+                raise
+            version, data = snapshot
+        else:
+            if profile.snapshot_path:
+                # A missing snapshot must not break the login
+                try:
+                    write_snapshot(profile.snapshot_path, data)
+                except OSError:
+                    pass
+
+    version = write_prepared(
+        profile.feed_key,
+        data,
+        timeout=profile.CACHE_DURATION,
+        lazy=LAZY_INDEXES
     )
 
-def get_or_set_cache():
+    return version, data
+
+def get_or_set_prepared(profile=None):
+    """
+    Returns the prepared data together with its version, prepares and caches it if necessary
+    On a cache miss, a recent snapshot in SHIB_DS_SNAPSHOT_PATH is tried before fetching the DiscoFeed
+    Concurrent cache misses within a worker share a single load, instead of preparing the DiscoFeed each
+    :param profile: Profile, the default profile if not given
+    :return: Tuple of version and prepared data, see prepare_feed
+    """
+    profile = profile or Profile()
+
+    version, data = read_prepared(profile.feed_key, partial(build_index, profile=profile))
+
+    if data is None:
+        # Profiles sharing a DiscoFeed share the load as well
+        version, data = _loads.do(profile.feed_key, partial(load_prepared, profile))
+
+    return version, data
+
+def get_or_set_cache(profile=None):
     """
     This is a shortcut that includes shibboleth discovery specific parameters
     It returns the idps and the index
+    :param profile: Profile, the default profile if not given
     """
-    idps, index = cache.get_or_set(
-        'shib_ds',
-        prepare_data,
-        timeout=settings.SHIB_DS_CACHE_DURATION
-    )
+    version, data = get_or_set_prepared(profile)
+
+    return data['idps'], data['index']
+
+
+def get_feed_version(profile=None):
+    """
+    Returns the version of the prepared data
+    Usually this is a single cache lookup, the data is only loaded if it is not cached
+    :param profile: Profile, the default profile if not given
+    """
+    profile = profile or Profile()
 
-    return idps, index
+    version = read_version(profile.feed_key)
+
+    if version is None:
+        version, data = get_or_set_prepared(profile)
+
+    return version
+
+
+def get_fragment_key(request, template_name, profile=None):
+    """
+    Returns the cache key of a rendered fragment of recent IdPs
+    The fragment depends only on the cookie, the language and the prepared data, so these make up the key
+    A new feed version results in new keys, old fragments simply expire
+    :param request: Request
+    :param template_name: Template of the fragment
+    :param profile: Profile, the default profile if not given
+    """
+    profile = profile or Profile()
+
+    # The cookie is hashed, since it may be long and contain characters that are not allowed in cache keys
+    fragment = '{}:{}'.format(template_name, request.COOKIES.get(profile.COOKIE_NAME, ''))
+
+    return '{}:fragment:{}:{}:{}'.format(
+        profile.cache_prefix,
+        get_feed_version(profile),
+        translation.get_language(),
+        hashlib.sha1(fragment.encode('utf-8')).hexdigest()
+    )
@@ -1,19 +1,44 @@
+import asyncio
 import json
 
-from urllib.parse import urlencode
-from urllib.parse import urljoin
+from functools import partial
+from functools import update_wrapper
 
-from django.conf import settings
-from django.contrib.sites.shortcuts import get_current_site
+from django.http import Http404
 from django.http import HttpResponse
 from django.http import HttpResponseBadRequest
 from django.http import HttpResponseRedirect
 from django.http import JsonResponse
+from django.utils import translation
 from django.views.generic.base import View
 
+from shibboleth_discovery.coalesce import SingleFlight
+from shibboleth_discovery.popularity import get_popular
+from shibboleth_discovery.popularity import record_selection
+from shibboleth_discovery.profiles import get_profile_for_request
+from shibboleth_discovery.redirect import get_redirect_url
+from shibboleth_discovery.utils import FACETS
 from shibboleth_discovery.utils import get_or_set_cache
+from shibboleth_discovery.utils import get_or_set_prepared
 from shibboleth_discovery.utils import search
+from shibboleth_discovery.utils import search_domain
+from shibboleth_discovery.utils import search_page
 from shibboleth_discovery.utils import set_cookie
+from shibboleth_discovery.utils import tokenize
+
+# Concurrent identical searches
+_searches = SingleFlight()
+
+
+def get_view_profile(request, kwargs):
+    """
+    Returns the profile chosen by the URL kwarg profile or by the site of the request
+    :raises Http404: If there is no such profile
+    """
+    try:
+        return get_profile_for_request(request, kwargs.get('profile'))
+    except ValueError:
+        raise Http404("Unknown profile.")
 
 
 class SearchView(View):
@@ -25,26 +50,226 @@ class SearchView(View):
     def get(self, request, *args, **kwargs):
         """
         Extracts the GET query string, triggers the search and returns a localized result
+        Facets are passed as GET arguments named after the facet, each one can be repeated
+        If there are more results, a cursor for the next page is returned
+        Concurrent identical searches within a worker share a single computation
         """
-        query = self.request.GET.get(settings.SHIB_DS_QUERY_PARAMETER, '')
-        data = self.search(query)[:settings.SHIB_DS_MAX_RESULTS]
+        profile = get_view_profile(request, kwargs)
+        query, cursor, facets, key = self.get_arguments(profile)
 
-        return JsonResponse(
-            {
-                'results' : settings.SHIB_DS_POST_PROCESSOR(data)
+        try:
+            results = _searches.do(key, partial(self.get_results, query, cursor, facets, profile))
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        return JsonResponse(results)
+
+    def get_arguments(self, profile):
+        """
+        Returns query, cursor and facets of the request and the key of the search for coalescing
+        """
+        query = self.request.GET.get(profile.QUERY_PARAMETER, '')
+        cursor = self.request.GET.get(profile.CURSOR_PARAMETER)
+        facets = {facet : self.request.GET.getlist(facet) for facet in FACETS if facet in self.request.GET}
+
+        key = (
+            # Subclasses may search differently
+            type(self),
+            profile.name,
+            query,
+            translation.get_language(),
+            profile.MAX_RESULTS,
+            cursor,
+            tuple(sorted((facet, tuple(values)) for facet, values in facets.items())),
+        )
+
+        return query, cursor, facets, key
+
+    def get_results(self, query, cursor, facets, profile):
+        """
+        Searches and returns the content of the response, which is shared by concurrent identical searches
+        An email address is looked up by its domain first
+        :raises ValueError: If the cursor is invalid or expired or a facet is unknown
+        """
+        # Users often type their email address, we resolve it by its domain
+        if '@' in query.strip() and ' ' not in query.strip() and not cursor:
+            data = search_domain(query, limit=profile.MAX_RESULTS, profile=profile, facets=facets)
+            if data:
+                return {
+                    'results' : profile.POST_PROCESSOR(data),
+                    'cursor' : None,
+                }
+
+        # Subclasses, that customize search, keep working, but without pagination
+        if type(self).search is not SearchView.search:
+            return {
+                'results' : profile.POST_PROCESSOR(self.search(query)[:profile.MAX_RESULTS]),
+                'cursor' : None,
             }
+
+        data, next_cursor = search_page(
+            tokenize(query),
+            profile.MAX_RESULTS,
+            cursor,
+            facets,
+            profile.FUZZY_SEARCH,
+            profile
         )
 
-    def search(self, query):
+        return {
+            'results' : profile.POST_PROCESSOR(data),
+            'cursor' : next_cursor,
+        }
+
+    def search(self, query, limit=None):
         """
         Performs the search and returns a list of IdP
+        This returns only the first page, see search_page for further pages
         :param query: Search query
+        :param limit: Maximum number of results
         :return: result as list
         """
-        # As search tokens, we allow only non-empty strings
+        profile = get_view_profile(self.request, self.kwargs)
         # The search function itself takes empty strings, they match anything, we do not want that here
-        tokens = [t for t in query.split(' ') if t.strip()]
-        return search(tokens)
+        data, next_cursor = search_page(tokenize(query), limit or profile.MAX_RESULTS, fuzzy=profile.FUZZY_SEARCH, profile=profile)
+        return data
+
+
+class AsyncSearchView(SearchView):
+    """
+    SearchView for ASGI servers, requires Django 3.1 or newer
+    Under ASGI, sync views of a worker run one after another in a single thread, so identical searches are never concurrent.
+    This view searches in the default executor, so concurrent identical searches share a single computation again.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+
+        # Django only awaits views, that are coroutine functions
+        async def async_view(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
+
+        return update_wrapper(async_view, view)
+
+    async def get(self, request, *args, **kwargs):
+        """
+        Like SearchView.get, but awaits the search
+        """
+        profile = get_view_profile(request, kwargs)
+        query, cursor, facets, key = self.get_arguments(profile)
+        language = translation.get_language()
+
+        # The executor does not know the language of the request
+        def get_results():
+            with translation.override(language):
+                return self.get_results(query, cursor, facets, profile)
+
+        try:
+            results = await _searches.do_async(key, get_results)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        return JsonResponse(results)
+
+
+class DomainLookupView(View):
+    """
+    Finds the IdPs belonging to a domain or an email address.
+    The domain is passed as single GET argument with keyword settings.SHIB_DS_QUERY_PARAMETER
+    """
+
+    def get(self, request, *args, **kwargs):
+        """
+        Extracts the GET query string, looks up the domain and returns a localized result
+        """
+        profile = get_view_profile(request, kwargs)
+
+        query = self.request.GET.get(profile.QUERY_PARAMETER, '')
+        data = search_domain(query, limit=profile.MAX_RESULTS, profile=profile)
+
+        return JsonResponse(
+            {
+                'results' : profile.POST_PROCESSOR(data)
+            }
+        )
+
+
+class BatchSearchView(View):
+    """
+    Runs several searches against the DiscoFeed at once.
+    The feed is loaded only once for all queries.
+    """
+
+    def post(self, request, *args, **kwargs):
+        """
+        Expects a JSON object with a list of queries, e.g.
+        {"queries" : ["Darmstadt", {"query" : "Bochum", "limit" : 1, "language" : "de", "facets" : {...}, "fuzzy" : true}]}
+        and returns the results grouped by query in the same order
+        """
+        profile = get_view_profile(request, kwargs)
+
+        try:
+            queries = json.loads(request.body.decode('utf-8')).get('queries')
+        except (json.JSONDecodeError, UnicodeDecodeError, AttributeError):
+            return HttpResponseBadRequest("Invalid JSON.")
+
+        if not isinstance(queries, list) or not queries:
+            return HttpResponseBadRequest("Queries must be a non-empty list.")
+
+        if len(queries) > profile.MAX_BATCH_QUERIES:
+            return HttpResponseBadRequest("Too many queries.")
+
+        queries = [{'query' : query} if isinstance(query, str) else query for query in queries]
+
+        for query in queries:
+            if not isinstance(query, dict) or not isinstance(query.get('query'), str):
+                return HttpResponseBadRequest("Each query must be a string or contain a query string.")
+            limit = query.get('limit', profile.MAX_RESULTS)
+            # bool is a subclass of int, but true is no limit
+            if not isinstance(limit, int) or isinstance(limit, bool) or not 0 < limit <= profile.MAX_RESULTS:
+                return HttpResponseBadRequest("Limit must be between 1 and {}.".format(profile.MAX_RESULTS))
+            if not isinstance(query.get('language', ''), str):
+                return HttpResponseBadRequest("Language must be a string.")
+            facets = query.get('facets', {})
+            if not isinstance(facets, dict) or not all(
+                isinstance(values, list) and all(isinstance(value, str) for value in values) for values in facets.values()
+            ):
+                return HttpResponseBadRequest("Facets must map to lists of values.")
+            if any(facet not in FACETS for facet in facets):
+                return HttpResponseBadRequest("Unknown facet.")
+            if not isinstance(query.get('fuzzy', False), bool):
+                return HttpResponseBadRequest("Fuzzy must be a boolean.")
+
+        version, data = get_or_set_prepared(profile)
+        boost = get_popular(version, data['idps'], profile)
+
+        results = []
+        for query in queries:
+            with translation.override(query.get('language') or translation.get_language()):
+                idps = search(
+                    tokenize(query.get('query')),
+                    data=data,
+                    limit=query.get('limit', profile.MAX_RESULTS),
+                    facets=query.get('facets'),
+                    fuzzy=query.get('fuzzy', profile.FUZZY_SEARCH),
+                    boost=boost
+                )
+            results.append(
+                {
+                    'query' : query.get('query'),
+                    'results' : profile.POST_PROCESSOR(idps),
+                }
+            )
+
+        return JsonResponse(
+            {
+                'results' : results
+            }
+        )
 
 
 class SetCookieView(View):
@@ -56,6 +281,8 @@ class SetCookieView(View):
         """
         Sets a cookie with POST content
         """
+        profile = get_view_profile(request, kwargs)
+
         try:
             entity_id = json.loads(request.body.decode('utf-8')).get('entity_id', '')
         except json.JSONDecodeError:
@@ -64,11 +291,12 @@ class SetCookieView(View):
         if not entity_id:
             return HttpResponseBadRequest("EntityID must not be empty.")
 
-        idps, index = get_or_set_cache()
+        idps, index = get_or_set_cache(profile)
         # We allow only known entityIDs to be saved
         if entity_id in [idp.get('entity_id') for idp in idps]:
             response = HttpResponse()
-            set_cookie(response, self.request, entity_id)
+            # Selections are counted by the redirect only, which follows anyway
+            set_cookie(response, self.request, entity_id, profile)
             return response
         else:
             return HttpResponseBadRequest("EntityID does not exist.")
@@ -82,29 +310,22 @@ class RedirectView(View):
     def get(self, request, *args, **kwargs):
         """
         Does a simple check, sets a cookie and redirects
+        The redirect URL is built from a base, that is resolved once per host, see get_redirect_url
         """
+        profile = get_view_profile(request, kwargs)
+
         entity_id = request.GET.get('entityID')
 
         if not entity_id:
             return HttpResponseBadRequest("EntityID must not be empty.")
 
-        idps, index = get_or_set_cache()
+        idps, index = get_or_set_cache(profile)
         # We allow only known entityIDs to be saved
         if any(entity_id==idp.get('entity_id') for idp in idps):
-            # We construct some more parameters for the Redirect
-            target = urljoin('https://{}'.format(get_current_site(request)), request.GET.get('next', ''))
-            params = {
-                'target' : target,
-                settings.SHIB_DS_RETURN_ID_PARAM : entity_id,
-            }
-            url = '{}?{}'.format(
-                settings.SHIB_DS_SP_URL,
-                urlencode(params)
-            )
-
-            response = HttpResponseRedirect(url)
+            response = HttpResponseRedirect(get_redirect_url(request, entity_id, profile))
 
-            set_cookie(response, self.request, entity_id)
+            set_cookie(response, self.request, entity_id, profile)
+            record_selection(entity_id, profile)
 
             return response
         else:
@@ -0,0 +1,182 @@
+import asyncio
+import pytest
+import threading
+import time
+
+from django.core.cache import cache
+from django.urls import reverse
+
+from shibboleth_discovery import utils
+from shibboleth_discovery import views
+from shibboleth_discovery.coalesce import SingleFlight
+
+
+def run_concurrently(function, callers=5):
+    """
+    Starts a leader and, once it is computing, the other callers, which must then wait for the leader
+    Returns the results or exceptions of all callers
+    """
+    results = [None] * callers
+
+    def run(number):
+        try:
+            results[number] = function()
+        except Exception as e:
+            results[number] = e
+
+    threads = [threading.Thread(target=run, args=(number,)) for number in range(callers)]
+    return threads, results
+
+
+def run_async(coroutine):
+    """
+    Runs a coroutine in a new event loop, asyncio.run is not available on Python 3.6
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class Blocking:
+    """
+    A function that blocks until it is released and counts its calls
+    """
+
+    def __init__(self, result=None, error=None):
+        self.calls = 0
+        self.started = threading.Event()
+        self.released = threading.Event()
+        self.result = result
+        self.error = error
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self.released.wait(5)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def coalesce(function, leader, callers=5):
+    """
+    Runs function concurrently, while leader blocks the first call
+    """
+    threads, results = run_concurrently(function, callers)
+    threads[0].start()
+    assert leader.started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # Give the followers time to arrive at the pending call
+    time.sleep(0.1)
+    leader.released.set()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+class TestSingleFlight:
+
+    def test_coalesced(self):
+        flight = SingleFlight()
+        function = Blocking(result=['spam'])
+        results = coalesce(lambda: flight.do('key', function), function)
+        assert function.calls == 1
+        assert all(result is results[0] for result in results)
+
+    def test_error(self):
+        flight = SingleFlight()
+        function = Blocking(error=ValueError('spam'))
+        results = coalesce(lambda: flight.do('key', function), function)
+        assert function.calls == 1
+        assert all(isinstance(result, ValueError) for result in results)
+
+    def test_forgotten(self):
+        flight = SingleFlight()
+        assert flight.do('key', lambda: 'spam') == 'spam'
+        assert flight.do('key', lambda: 'ham') == 'ham'
+        with pytest.raises(ValueError):
+            flight.do('key', lambda: int('spam'))
+        assert flight.do('key', lambda: 'eggs') == 'eggs'
+
+    def test_keys(self):
+        flight = SingleFlight()
+        function = Blocking(result='spam')
+        threads, results = run_concurrently(lambda: flight.do('key', function), 1)
+        threads[0].start()
+        assert function.started.wait(5)
+        # A different key is not blocked
+        assert flight.do('other', lambda: 'ham') == 'ham'
+        function.released.set()
+        threads[0].join(5)
+        assert results == ['spam']
+
+    def test_async(self):
+        flight = SingleFlight()
+        calls = []
+
+        def function():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'spam'
+
+        async def main():
+            return await asyncio.gather(*[flight.do_async('key', function) for _ in range(5)])
+
+        assert run_async(main()) == ['spam'] * 5
+        assert len(calls) == 1
+
+
+class TestCoalescedLoads:
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        cache.clear()
+        yield
+        cache.clear()
+
+    def test_prepare_once(self, monkeypatch):
+        prepare_feed = utils.prepare_feed
+        function = Blocking()
+        def blocking_prepare_feed(profile=None):
+            function()
+            return prepare_feed(profile)
+        monkeypatch.setattr(utils, 'prepare_feed', blocking_prepare_feed)
+
+        results = coalesce(utils.get_or_set_prepared, function)
+        assert function.calls == 1
+        assert all(result == results[0] for result in results)
+
+    def test_search_once(self, rf, monkeypatch):
+        search_page = views.search_page
+        function = Blocking()
+        def blocking_search_page(*args, **kwargs):
+            function()
+            return search_page(*args, **kwargs)
+        monkeypatch.setattr(views, 'search_page', blocking_search_page)
+
+        view = views.SearchView.as_view()
+        results = coalesce(lambda: view(rf.get(reverse('shib_ds:search'), {'q' : 'Darmstadt'})), function)
+        assert function.calls == 1
+        assert all(result.content == results[0].content for result in results)
+        assert b'Darmstadt' in results[0].content
+
+    def test_async_search_once(self, rf, monkeypatch):
+        search_page = views.search_page
+        calls = []
+        def slow_search_page(*args, **kwargs):
+            calls.append(1)
+            time.sleep(0.1)
+            return search_page(*args, **kwargs)
+        monkeypatch.setattr(views, 'search_page', slow_search_page)
+
+        view = views.AsyncSearchView.as_view()
+        async def main():
+            return await asyncio.gather(*[view(rf.get(reverse('shib_ds:search'), {'q' : 'Darmstadt'})) for _ in range(5)])
+
+        results = run_async(main())
+        assert len(calls) == 1
+        assert all(result.content == results[0].content for result in results)
+        assert b'Darmstadt' in results[0].content
@@ -1,5 +1,16 @@
+import os
+import time
+
+import pytest
+
 from django.core.cache import cache
 from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from shibboleth_discovery.storage import read_prepared
+from shibboleth_discovery.storage import read_snapshot
+from shibboleth_discovery.storage import write_snapshot
+from shibboleth_discovery.utils import get_or_set_cache
 
 class TestManagementCommands:
 
@@ -7,3 +18,85 @@ class TestManagementCommands:
         assert cache.get('shib_ds') is None
         call_command('update_shib_ds_cache')
         assert cache.get('shib_ds') is not None
+
+    def test_update_snapshot(self, settings, tmp_path):
+        settings.SHIB_DS_SNAPSHOT_PATH = str(tmp_path / 'snapshot')
+        call_command('update_shib_ds_cache')
+        assert read_snapshot(settings.SHIB_DS_SNAPSHOT_PATH) == read_prepared('shib_ds')
+
+    def test_cold_start_from_snapshot(self, settings, tmp_path):
+        settings.SHIB_DS_SNAPSHOT_PATH = str(tmp_path / 'snapshot')
+        call_command('update_shib_ds_cache')
+        idps, index = get_or_set_cache()
+        # The cache is empty and the DiscoFeed is unreachable
+        cache.clear()
+        settings.SHIB_DS_DISCOFEED_PATH = 'spam'
+        assert get_or_set_cache() == (idps, index)
+        # and the cache is filled again
+        assert read_prepared('shib_ds')[1] is not None
+
+    def test_stale_snapshot(self, settings, tmp_path):
+        settings.SHIB_DS_SNAPSHOT_PATH = str(tmp_path / 'snapshot')
+        write_snapshot(settings.SHIB_DS_SNAPSHOT_PATH, {'idps' : [], 'index' : []})
+        age = settings.SHIB_DS_CACHE_DURATION + 1
+        os.utime(settings.SHIB_DS_SNAPSHOT_PATH, (time.time() - age, time.time() - age))
+        cache.clear()
+        # The DiscoFeed is reachable, so it is preferred to the stale snapshot
+        idps, index = get_or_set_cache()
+        assert idps
+        # and replaces the snapshot
+        assert read_snapshot(settings.SHIB_DS_SNAPSHOT_PATH) == read_prepared('shib_ds')
+
+    def test_stale_snapshot_unreachable_feed(self, settings, tmp_path):
+        settings.SHIB_DS_SNAPSHOT_PATH = str(tmp_path / 'snapshot')
+        call_command('update_shib_ds_cache')
+        idps, index = get_or_set_cache()
+        age = settings.SHIB_DS_CACHE_DURATION + 1
+        os.utime(settings.SHIB_DS_SNAPSHOT_PATH, (time.time() - age, time.time() - age))
+        cache.clear()
+        settings.SHIB_DS_DISCOFEED_PATH = 'spam'
+        assert get_or_set_cache() == (idps, index)
+
+    def test_unreachable_feed_without_snapshot(self, settings, tmp_path):
+        settings.SHIB_DS_SNAPSHOT_PATH = str(tmp_path / 'snapshot')
+        settings.SHIB_DS_DISCOFEED_PATH = 'spam'
+        cache.clear()
+        with pytest.raises(Exception):
+            get_or_set_cache()
+
+    def test_snapshot_on_cache_miss(self, settings, tmp_path):
+        settings.SHIB_DS_SNAPSHOT_PATH = str(tmp_path / 'snapshot')
+        cache.clear()
+        get_or_set_cache()
+        assert read_snapshot(settings.SHIB_DS_SNAPSHOT_PATH) == read_prepared('shib_ds')
+
+    def test_unwritable_snapshot_on_cache_miss(self, settings, tmp_path):
+        settings.SHIB_DS_SNAPSHOT_PATH = str(tmp_path / 'spam' / 'snapshot')
+        cache.clear()
+        assert get_or_set_cache()
+
+    def test_parallel(self):
+        call_command('update_shib_ds_cache')
+        version, expected = read_prepared('shib_ds')
+        # The lazy indexes must be read before clearing the cache
+        expected = expected.load_all()
+        cache.clear()
+        # Chunks of a single IdP, so that the chunks are really merged
+        call_command('update_shib_ds_cache', workers=2, chunk_size=1)
+        version, data = read_prepared('shib_ds')
+        assert data == expected
+        # The same chunks result in the same version
+        cache.clear()
+        call_command('update_shib_ds_cache', workers=2, chunk_size=1)
+        assert read_prepared('shib_ds')[0] == version
+
+    def test_timings(self, capsys):
+        call_command('update_shib_ds_cache')
+        out = capsys.readouterr().out
+        for stage in ('fetch', 'idps', 'facets', 'fuzzy', 'domains', 'cache', 'total'):
+            assert stage in out
+
+    @pytest.mark.parametrize('option', ['workers', 'chunk_size'])
+    def test_invalid_option(self, option):
+        with pytest.raises(CommandError):
+            call_command('update_shib_ds_cache', **{option : 0})
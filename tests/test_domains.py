@@ -0,0 +1,79 @@
+import pytest
+
+from shibboleth_discovery.domains import build_domain_index
+from shibboleth_discovery.domains import get_host
+from shibboleth_discovery.domains import get_parent_domains
+from shibboleth_discovery.domains import lookup
+from shibboleth_discovery.domains import normalize_domain
+from shibboleth_discovery.utils import prepare_data
+
+
+class TestHelpers:
+
+    @pytest.mark.parametrize('domain, expected', [
+        ('user@TU-Darmstadt.de', 'tu-darmstadt.de'),
+        (' tu-darmstadt.de. ', 'tu-darmstadt.de'),
+        ('user@mail@tu-darmstadt.de', 'tu-darmstadt.de'),
+    ])
+    def test_normalize_domain(self, domain, expected):
+        assert normalize_domain(domain) == expected
+
+    @pytest.mark.parametrize('url, expected', [
+        ('https://idp.hrz.tu-darmstadt.de/idp/shibboleth', 'idp.hrz.tu-darmstadt.de'),
+        ('urn:mace:spam', None),
+        ('', None),
+    ])
+    def test_get_host(self, url, expected):
+        assert get_host(url) == expected
+
+    @pytest.mark.parametrize('domain, expected', [
+        ('idp.hrz.tu-darmstadt.de', ['idp.hrz.tu-darmstadt.de', 'hrz.tu-darmstadt.de', 'tu-darmstadt.de']),
+        ('idp.ox.ac.uk', ['idp.ox.ac.uk', 'ox.ac.uk']),
+        ('ac.uk', ['ac.uk']),
+        ('de', []),
+    ])
+    def test_get_parent_domains(self, domain, expected):
+        assert get_parent_domains(domain) == expected
+
+
+class TestLookup:
+
+    @pytest.fixture
+    def domain_index(self):
+        idps, index = prepare_data()
+        return build_domain_index(idps)
+
+    @pytest.mark.parametrize('query, expected', [
+        # Domain hint
+        ('user@tu-darmstadt.de', [0]),
+        # Walk up the parent domains
+        ('user@stud.tu-darmstadt.de', [0]),
+        # Parent domain of the entityID and InformationURL
+        ('user@uni-kassel.de', [1]),
+        ('user@hs-bochum.de', [2]),
+        ('hs-bochum.de', [2]),
+        ('user@spam.de', []),
+        ('', []),
+    ])
+    def test_lookup(self, domain_index, query, expected):
+        assert lookup(query, domain_index) == expected
+
+    def test_hints_first(self):
+        idps = [
+            {'entity_id' : 'https://idp.example.org/idp'},
+            {'entity_id' : 'https://idp.other.org/idp', 'domain_hints' : ['example.org']},
+        ]
+        assert lookup('user@example.org', build_domain_index(idps)) == [1, 0]
+
+    def test_scopes(self):
+        idps = [
+            {'entity_id' : 'https://idp.example.org/idp', 'scopes' : ['example.com']},
+        ]
+        assert lookup('user@example.com', build_domain_index(idps)) == [0]
+
+    def test_no_duplicates(self):
+        idps = [
+            {'entity_id' : 'https://idp.example.org/idp', 'domain_hints' : ['example.org'], 'information_url' : {'en' : 'https://www.example.org'}},
+            {'entity_id' : 'https://login.example.org/idp', 'scopes' : ['example.org']},
+        ]
+        assert build_domain_index(idps)['example.org'] == [0, 1]
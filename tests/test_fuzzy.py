@@ -0,0 +1,56 @@
+import pytest
+
+from shibboleth_discovery.fuzzy import build_fuzzy_index
+from shibboleth_discovery.fuzzy import edit_distance
+from shibboleth_discovery.fuzzy import get_deletes
+from shibboleth_discovery.fuzzy import lookup
+
+
+class TestGetDeletes:
+
+    def test_distance_zero(self):
+        assert get_deletes('spam', 0) == {'spam'}
+
+    def test_distance_one(self):
+        assert get_deletes('spam', 1) == {'spam', 'pam', 'sam', 'spm', 'spa'}
+
+    def test_distance_two(self):
+        assert 'sa' in get_deletes('spam', 2)
+
+
+class TestEditDistance:
+
+    @pytest.mark.parametrize('a, b, expected', [
+        ('darmstadt', 'darmstadt', 0),
+        ('darmstdat', 'darmstadt', 1), # Transposition
+        ('darmstad', 'darmstadt', 1), # Deletion
+        ('darmsttadt', 'darmstadt', 1), # Insertion
+        ('darnstadt', 'darmstadt', 1), # Substitution
+        ('dramstdat', 'darmstadt', 2),
+        ('kassel', 'darmstadt', 3), # Capped at distance + 1
+    ])
+    def test_edit_distance(self, a, b, expected):
+        assert edit_distance(a, b, 2) == expected
+
+
+class TestLookup:
+
+    index = ['technische universität darmstadt', 'universität kassel', 'hochschule bochum bochum university of applied sciences']
+
+    @pytest.mark.parametrize('token, expected', [
+        ('darmstdat', {0}),
+        ('universitat', {0, 1}),
+        ('kasel', {1}),
+        ('kassel', {1}),
+        ('bochun', {2}),
+        ('of', set()), # Too short
+        ('dramstdat', set()), # Too far
+    ])
+    def test_lookup(self, token, expected):
+        assert lookup(token, build_fuzzy_index(self.index, 1)) == expected
+
+    def test_distance_two(self):
+        assert lookup('dramstdat', build_fuzzy_index(self.index, 2)) == {0}
+
+    def test_disabled(self):
+        assert lookup('darmstdat', build_fuzzy_index(self.index, 0)) == set()
@@ -0,0 +1,138 @@
+import json
+import pytest
+
+from django.core.cache import cache
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from shibboleth_discovery.loadtest import CacheCounter
+from shibboleth_discovery.loadtest import LoadTest
+from shibboleth_discovery.loadtest import make_feed
+from shibboleth_discovery.loadtest import percentile
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+    yield
+    cache.clear()
+
+
+def run(capsys, **options):
+    call_command('shib_ds_loadtest', json=True, **options)
+    return json.loads(capsys.readouterr().out)
+
+
+class TestHelpers:
+
+    def test_make_feed(self):
+        feed = make_feed(50, seed=1)
+        assert len(feed) == 50
+        assert len(set(idp['entityID'] for idp in feed)) == 50
+        assert feed == make_feed(50, seed=1)
+        assert feed != make_feed(50, seed=2)
+
+    @pytest.mark.parametrize('values, p, expected', [
+        ([], 50, None),
+        ([1], 99, 1),
+        ([1, 2, 3, 4], 50, 2),
+        ([1, 2, 3, 4], 90, 4),
+        (list(range(1, 101)), 99, 99),
+    ])
+    def test_percentile(self, values, p, expected):
+        assert percentile(values, p) == expected
+
+    def test_cache_counter(self):
+        cls = type(caches['default'])
+        get = cls.get
+        with CacheCounter().patch() as counter:
+            cache.set('spam', 1)
+            cache.get('spam')
+            # get_many of the local memory cache calls get, but this is a single round trip
+            cache.get_many(['spam', 'ham'])
+        assert counter.calls == 3
+        assert cls.get is get
+        assert 'get_many' not in cls.__dict__
+
+
+class RecordingClient:
+    """
+    Answers every search with all entityIDs and records the parameters
+    """
+
+    def __init__(self, idps, requests):
+        self.content = ' '.join(entity_id for entity_id, name in idps).encode('utf-8')
+        self.requests = requests
+
+    def get(self, path, params):
+        self.requests.append((path, params))
+        return 200, self.content
+
+    def post(self, path, data):
+        self.requests.append((path, data))
+        return 200, b''
+
+
+class TestLoadTest:
+
+    @pytest.mark.parametrize('kwargs, parameter', [({}, 'q'), ({'query_parameter' : 'spam'}, 'spam')])
+    def test_query_parameter(self, kwargs, parameter):
+        idps = [('https://idp.example.org/idp/shibboleth', 'Example')]
+        urls = {'search' : '/search/', 'redirect' : '/redirect/', 'remember-idp' : '/remember-idp/'}
+        requests = []
+        load_test = LoadTest(idps, urls, lambda: RecordingClient(idps, requests), sessions=1, concurrency=1, cookie_reuse=0, **kwargs)
+        load_test.run()
+        assert requests[0] == ('/search/', {parameter : 'E'})
+
+
+class TestCommand:
+
+    def test_local(self, capsys):
+        stats = run(capsys, sessions=20, concurrency=4, cookie_reuse=0.5)
+        assert set(stats) == {'search', 'redirect', 'remember-idp', 'total'}
+        assert stats['redirect']['requests'] == 20
+        assert stats['total']['errors'] == 0
+        assert stats['total']['cache_calls'] > 0
+        assert stats['total']['p50'] <= stats['total']['p99'] <= stats['total']['max']
+
+    def test_feed_size(self, capsys):
+        stats = run(capsys, sessions=5, concurrency=2, feed_size=200)
+        assert stats['total']['errors'] == 0
+        # Only the prepared default DiscoFeed stays in the cache, not the synthetic one nor the counters
+        assert [key for key in cache._cache if 'shib_ds_loadtest' in key or 'popularity' in key or 'shib_ds:feed:' in key] == []
+
+    def test_query_parameter(self, capsys, settings):
+        settings.SHIB_DS_QUERY_PARAMETER = 'spam'
+        stats = run(capsys, sessions=5, concurrency=1, cookie_reuse=0)
+        # Each IdP is found after a few letters, instead of typing the whole name
+        assert stats['search']['requests'] < 5 * 10
+
+    def test_snapshot(self, capsys, settings, tmp_path):
+        settings.SHIB_DS_SNAPSHOT_PATH = str(tmp_path / 'snapshot')
+        run(capsys, sessions=2, concurrency=1, feed_size=10)
+        run(capsys, sessions=2, concurrency=1)
+        assert list(tmp_path.iterdir()) == []
+
+    def test_table(self, capsys):
+        call_command('shib_ds_loadtest', sessions=2, concurrency=1)
+        out = capsys.readouterr().out
+        assert 'p99' in out
+        assert 'Cache round trips' in out
+
+    def test_remote(self, capsys, live_server):
+        stats = run(capsys, sessions=5, concurrency=2, url=live_server.url)
+        assert stats['redirect']['requests'] == 5
+        assert stats['total']['errors'] == 0
+        assert 'cache_calls' not in stats['total']
+
+    @pytest.mark.parametrize('options', [
+        {'sessions' : 0},
+        {'concurrency' : 0},
+        {'cookie_reuse' : 2},
+        {'feed_size' : 0},
+        {'feed_size' : 10, 'url' : 'http://localhost:8000'},
+    ])
+    def test_invalid_options(self, options):
+        with pytest.raises(CommandError):
+            call_command('shib_ds_loadtest', **options)
@@ -0,0 +1,44 @@
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from shibboleth_discovery.fuzzy import build_fuzzy_index
+from shibboleth_discovery.parallel import map_chunks
+from shibboleth_discovery.parallel import measure
+from shibboleth_discovery.parallel import split
+from shibboleth_discovery.utils import prepare_data
+
+
+def double(chunk):
+    return [item * 2 for item in chunk]
+
+
+class TestParallel:
+
+    @pytest.mark.parametrize('items, size, expected', [
+        ([1, 2, 3], 2, [[1, 2], [3]]),
+        ([1, 2], 2, [[1, 2]]),
+        ([], 2, []),
+    ])
+    def test_split(self, items, size, expected):
+        assert split(items, size) == expected
+
+    def test_map_chunks(self):
+        items = list(range(100))
+        with ThreadPoolExecutor(4) as executor:
+            assert map_chunks(double, items, executor, chunk_size=7) == map_chunks(double, items) == [item * 2 for item in items]
+
+    def test_measure(self):
+        timings = {}
+        with measure(timings, 'spam'):
+            pass
+        with measure(timings, 'spam'):
+            pass
+        assert list(timings) == ['spam']
+        with measure(None, 'spam'):
+            pass
+
+    def test_fuzzy_index(self):
+        idps, index = prepare_data()
+        with ThreadPoolExecutor(2) as executor:
+            assert build_fuzzy_index(index, 1, executor, chunk_size=1) == build_fuzzy_index(index, 1)
@@ -0,0 +1,141 @@
+import json
+import pytest
+
+from django.core.cache import cache
+from django.urls import reverse
+
+from shibboleth_discovery.loadtest import CacheCounter
+from shibboleth_discovery.popularity import flush
+from shibboleth_discovery.popularity import get_counter_key
+from shibboleth_discovery.popularity import get_popular
+from shibboleth_discovery.popularity import rank_idps
+from shibboleth_discovery.popularity import record_selection
+from shibboleth_discovery.utils import get_popular_idps
+from shibboleth_discovery.utils import prepare_data
+from shibboleth_discovery.utils import search
+from shibboleth_discovery.utils import search_page
+
+
+IDP_DA = 'https://idp.hrz.tu-darmstadt.de/idp/shibboleth'
+IDP_KS = 'https://idp.hrz.uni-kassel.de/idp/shibboleth-idp'
+IDP_BO = 'https://idp.hs-bochum.de/idp/shibboleth'
+
+
+@pytest.fixture(autouse=True)
+def clear_counters():
+    # Counters must not influence the order of other tests
+    flush()
+    cache.clear()
+    yield
+    flush()
+    cache.clear()
+
+
+class TestRecordSelection:
+
+    def test_batch(self, settings):
+        settings.SHIB_DS_POPULARITY_FLUSH_SIZE = 3
+        record_selection(IDP_DA)
+        record_selection(IDP_KS)
+        assert cache.get(get_counter_key(IDP_DA)) is None
+        record_selection(IDP_DA)
+        assert cache.get(get_counter_key(IDP_DA)) == 2
+        assert cache.get(get_counter_key(IDP_KS)) == 1
+
+    def test_increment(self, settings):
+        settings.SHIB_DS_POPULARITY_FLUSH_SIZE = 1
+        record_selection(IDP_DA)
+        record_selection(IDP_DA)
+        assert cache.get(get_counter_key(IDP_DA)) == 2
+
+    def test_single_round_trip(self, settings):
+        settings.SHIB_DS_POPULARITY_FLUSH_SIZE = 1
+        record_selection(IDP_DA)
+        with CacheCounter().patch() as counter:
+            record_selection(IDP_DA)
+        assert counter.calls == 1
+        assert cache.get(get_counter_key(IDP_DA)) == 2
+
+    def test_interval(self, settings):
+        settings.SHIB_DS_POPULARITY_FLUSH_INTERVAL = 0
+        record_selection(IDP_DA)
+        assert cache.get(get_counter_key(IDP_DA)) == 1
+
+    def test_disabled(self, settings):
+        settings.SHIB_DS_POPULARITY_FLUSH_SIZE = 1
+        settings.SHIB_DS_POPULAR_IDPS = 0
+        record_selection(IDP_DA)
+        assert cache.get(get_counter_key(IDP_DA)) is None
+
+    def test_views(self, client, settings):
+        settings.SHIB_DS_POPULARITY_FLUSH_SIZE = 1
+        # Remembering and redirecting is a single selection
+        client.post(reverse('shib_ds:remember-idp'), {'entity_id' : IDP_DA}, 'application/json')
+        client.get(reverse('shib_ds:redirect'), {'entityID' : IDP_DA})
+        # Unknown IdPs are not counted
+        client.get(reverse('shib_ds:redirect'), {'entityID' : 'spam'})
+        assert cache.get(get_counter_key(IDP_DA)) == 1
+        assert cache.get(get_counter_key('spam')) is None
+
+
+class TestPopular:
+
+    def select(self, settings, *entity_ids):
+        settings.SHIB_DS_POPULARITY_FLUSH_SIZE = 1
+        for entity_id in entity_ids:
+            record_selection(entity_id)
+
+    def test_rank_idps(self, settings):
+        self.select(settings, IDP_BO, IDP_KS, IDP_BO)
+        idps, index = prepare_data()
+        assert rank_idps(idps) == [2, 1]
+        settings.SHIB_DS_POPULAR_IDPS = 1
+        assert rank_idps(idps) == [2]
+
+    def test_refresh(self, settings):
+        idps, index = prepare_data()
+        assert get_popular('spam', idps) == []
+        self.select(settings, IDP_BO)
+        # Still the old list until refreshed
+        assert get_popular('spam', idps) == []
+        assert get_popular('ham', idps) == [2]
+
+    def test_get_popular_idps(self, settings):
+        self.select(settings, IDP_KS)
+        assert [idp.get('entity_id') for idp in get_popular_idps()] == [IDP_KS]
+
+    def test_context(self, client, settings):
+        self.select(settings, IDP_KS)
+        shib_ds = client.get(reverse('login-mixin')).context.get('shib_ds')
+        assert [idp.get('entity_id') for idp in shib_ds.get('popular_idps')] == [IDP_KS]
+
+    def test_search_ranking(self, settings):
+        self.select(settings, IDP_KS)
+        assert [idp.get('entity_id') for idp in search(['Universität'])] == [IDP_KS, IDP_DA]
+        # Popular IdPs must match as well
+        assert [idp.get('entity_id') for idp in search(['Darmstadt'])] == [IDP_DA]
+
+    def test_search_page_ranking(self, settings):
+        self.select(settings, IDP_BO, IDP_KS, IDP_BO)
+        results, cursor = search_page(['a'], 2)
+        assert [idp.get('entity_id') for idp in results] == [IDP_BO, IDP_KS]
+        results, cursor = search_page(['a'], 2, cursor)
+        assert [idp.get('entity_id') for idp in results] == [IDP_DA]
+        assert cursor is None
+
+    def test_cursor_survives_refresh(self, settings):
+        self.select(settings, IDP_BO, IDP_KS, IDP_BO)
+        results, cursor = search_page(['a'], 2)
+        # The popular IdPs change, but the next page continues the order of the first one
+        settings.SHIB_DS_POPULAR_REFRESH = 0
+        cache.delete_many([key for key in cache._cache if ':popular:' in key])
+        self.select(settings, IDP_DA, IDP_DA, IDP_DA)
+        results, cursor = search_page(['a'], 2, cursor)
+        assert [idp.get('entity_id') for idp in results] == [IDP_DA]
+        assert cursor is None
+
+    def test_batch_search_ranking(self, client, settings):
+        self.select(settings, IDP_KS)
+        r = client.post(reverse('shib_ds:batch-search'), {'queries' : ['Universität']}, 'application/json')
+        results = json.loads(r.content.decode('utf-8')).get('results')
+        assert [idp.get('entity_id') for idp in results[0].get('results')] == [IDP_KS, IDP_DA]
@@ -0,0 +1,197 @@
+import importlib
+import json
+import pytest
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.template import RequestContext
+from django.urls import reverse
+
+from shibboleth_discovery import models
+from shibboleth_discovery import utils
+from shibboleth_discovery.profiles import Profile
+from shibboleth_discovery.profiles import get_profile
+from shibboleth_discovery.profiles import get_profile_for_request
+from shibboleth_discovery.profiles import get_profiles
+from shibboleth_discovery.storage import read_prepared
+from shibboleth_discovery.template_tags.shibboleth_discovery import shib_ds_context
+
+
+IDP_DA = 'https://idp.hrz.tu-darmstadt.de/idp/shibboleth'
+IDP_BO = 'https://idp.hs-bochum.de/idp/shibboleth'
+
+
+@pytest.fixture
+def profiles(settings, tmp_path):
+    """
+    Sets up a profile sharing the default DiscoFeed and one with its own DiscoFeed, containing only Bochum
+    """
+    with open(settings.SHIB_DS_DISCOFEED_PATH, 'r') as fin:
+        feed = json.load(fin)
+    path = str(tmp_path / 'DiscoFeed.json')
+    with open(path, 'w') as fout:
+        json.dump([idp for idp in feed if idp.get('entityID') == IDP_BO], fout)
+
+    settings.SHIB_DS_PROFILES = {
+        'shared' : {
+            'SP_URL' : 'https://shared.example.org/Shibboleth.sso/Login',
+        },
+        'bochum' : {
+            'DISCOFEED_PATH' : path,
+            'SP_URL' : 'https://bochum.example.org/Shibboleth.sso/Login',
+            'RETURN_ID_PARAM' : 'providerId',
+            'COOKIE_NAME' : '_saml_idp_bochum',
+        },
+    }
+    settings.SHIB_DS_SITE_PROFILES = {
+        'bochum.example.org' : 'bochum',
+    }
+    settings.ALLOWED_HOSTS = ['testserver', 'bochum.example.org']
+    cache.clear()
+    yield
+    cache.clear()
+
+
+class TestProfile:
+
+    def test_fallback(self, settings, profiles):
+        assert get_profile('shared').SP_URL == 'https://shared.example.org/Shibboleth.sso/Login'
+        assert get_profile('shared').RETURN_ID_PARAM == settings.SHIB_DS_RETURN_ID_PARAM
+        assert get_profile().SP_URL == settings.SHIB_DS_SP_URL
+
+    def test_own_feed(self, settings, profiles):
+        settings.SHIB_DS_DISCOFEED_URL = 'https://shib.ds/DiscoFeed'
+        # The global URL must not win over the own path
+        assert get_profile('bochum').DISCOFEED_URL is None
+        assert get_profile('shared').DISCOFEED_URL == 'https://shib.ds/DiscoFeed'
+
+    def test_unknown(self, profiles):
+        with pytest.raises(ValueError):
+            get_profile('spam')
+
+    @pytest.mark.parametrize('options', [
+        {'SP_ULR' : 'https://spam.example.org/Shibboleth.sso/Login'},
+        {'SITE_PROFILES' : {}},
+        {'SP_URL' : ''},
+        {'DISCOFEED_URL' : None},
+        {'DISCOFEED_URL' : None, 'DISCOFEED_PATH' : ''},
+    ])
+    def test_invalid(self, settings, options):
+        settings.SHIB_DS_PROFILES = {'spam' : options}
+        try:
+            with pytest.raises(ImproperlyConfigured):
+                importlib.reload(models)
+        finally:
+            settings.SHIB_DS_PROFILES = {}
+            importlib.reload(models)
+
+    def test_valid(self, settings, profiles):
+        settings.SHIB_DS_PROFILES['spam'] = {'DISCOFEED_URL' : 'https://spam.example.org/DiscoFeed', 'FUZZY_SEARCH' : True}
+        importlib.reload(models)
+
+    def test_feed_key(self, profiles):
+        assert get_profile().feed_key == 'shib_ds'
+        assert get_profile('shared').feed_key == 'shib_ds'
+        assert get_profile('bochum').feed_key != 'shib_ds'
+
+    def test_cache_prefix(self, profiles):
+        assert get_profile().cache_prefix == 'shib_ds'
+        assert get_profile('shared').cache_prefix != get_profile('bochum').cache_prefix != 'shib_ds'
+
+    def test_get_profiles(self, profiles):
+        assert get_profiles() == [Profile(), Profile('bochum'), Profile('shared')]
+
+    def test_site(self, rf, profiles):
+        assert get_profile_for_request(rf.get('/', HTTP_HOST='bochum.example.org')) == Profile('bochum')
+        assert get_profile_for_request(rf.get('/')) == Profile()
+        # The name wins
+        assert get_profile_for_request(rf.get('/', HTTP_HOST='bochum.example.org'), 'shared') == Profile('shared')
+
+
+class TestIsolation:
+
+    def test_search(self, profiles):
+        assert [idp.get('entity_id') for idp in utils.search(['a'], profile=get_profile('bochum'))] == [IDP_BO]
+        assert len(utils.search(['a'], profile=get_profile('shared'))) == 3
+
+    def test_shared_feed_prepared_once(self, profiles, monkeypatch):
+        calls = []
+        get_feed = utils.get_feed
+        monkeypatch.setattr(utils, 'get_feed', lambda profile=None: calls.append(profile) or get_feed(profile))
+        utils.get_or_set_cache()
+        utils.get_or_set_cache(get_profile('shared'))
+        utils.get_or_set_cache(get_profile('bochum'))
+        assert calls == [Profile(), Profile('bochum')]
+
+    def test_command(self, profiles, monkeypatch):
+        calls = []
+        get_feed = utils.get_feed
+        monkeypatch.setattr(utils, 'get_feed', lambda profile=None: calls.append(profile) or get_feed(profile))
+        call_command('update_shib_ds_cache')
+        assert calls == [Profile(), Profile('bochum')]
+        assert read_prepared(get_profile('bochum').feed_key)[1] is not None
+
+    def test_snapshot_path(self, settings, profiles, tmp_path):
+        settings.SHIB_DS_SNAPSHOT_PATH = str(tmp_path / 'snapshot')
+        assert get_profile().snapshot_path == settings.SHIB_DS_SNAPSHOT_PATH
+        assert get_profile('shared').snapshot_path == settings.SHIB_DS_SNAPSHOT_PATH
+        assert get_profile('bochum').snapshot_path != settings.SHIB_DS_SNAPSHOT_PATH
+        settings.SHIB_DS_SNAPSHOT_PATH = None
+        assert get_profile('bochum').snapshot_path is None
+
+    def test_snapshot_per_feed(self, settings, profiles, tmp_path, monkeypatch):
+        settings.SHIB_DS_SNAPSHOT_PATH = str(tmp_path / 'snapshot')
+        call_command('update_shib_ds_cache')
+        # Both feeds come from their own snapshot, although the global path is the same
+        cache.clear()
+        monkeypatch.setattr(utils, 'get_feed', lambda profile=None: 1 / 0)
+        assert [idp.get('entity_id') for idp in utils.search(['a'], profile=get_profile('bochum'))] == [IDP_BO]
+        assert len(utils.search(['a'], profile=get_profile('shared'))) == 3
+
+    def test_command_single_profile(self, profiles):
+        call_command('update_shib_ds_cache', profile='bochum')
+        assert read_prepared('shib_ds') == (None, None)
+        assert read_prepared(get_profile('bochum').feed_key)[1] is not None
+
+
+class TestViews:
+
+    def test_search_by_kwarg(self, client, profiles):
+        r = client.get(reverse('shib_ds:search', kwargs={'profile' : 'bochum'}), {'q' : 'a'})
+        assert [idp.get('entity_id') for idp in json.loads(r.content.decode('utf-8')).get('results')] == [IDP_BO]
+
+    def test_search_by_site(self, client, profiles):
+        r = client.get(reverse('shib_ds:search'), {'q' : 'a'}, HTTP_HOST='bochum.example.org')
+        assert [idp.get('entity_id') for idp in json.loads(r.content.decode('utf-8')).get('results')] == [IDP_BO]
+
+    def test_unknown_profile(self, client, profiles):
+        r = client.get(reverse('shib_ds:search', kwargs={'profile' : 'spam'}), {'q' : 'a'})
+        assert r.status_code == 404
+
+    def test_redirect(self, client, profiles):
+        r = client.get(reverse('shib_ds:redirect', kwargs={'profile' : 'bochum'}), {'entityID' : IDP_BO})
+        assert r.url.startswith('https://bochum.example.org/Shibboleth.sso/Login?')
+        assert 'providerId=' in r.url
+        assert client.cookies.get('_saml_idp_bochum') is not None
+        # IdPs of other feeds are unknown
+        r = client.get(reverse('shib_ds:redirect', kwargs={'profile' : 'bochum'}), {'entityID' : IDP_DA})
+        assert r.status_code == 400
+
+    def test_remember_idp(self, client, profiles):
+        r = client.post(reverse('shib_ds:remember-idp', kwargs={'profile' : 'bochum'}), {'entity_id' : IDP_DA}, 'application/json')
+        assert r.status_code == 400
+        r = client.post(reverse('shib_ds:remember-idp', kwargs={'profile' : 'bochum'}), {'entity_id' : IDP_BO}, 'application/json')
+        assert r.status_code == 200
+
+    def test_mixin(self, client, profiles):
+        shib_ds = client.get(reverse('login-mixin'), HTTP_HOST='bochum.example.org').context.get('shib_ds')
+        assert shib_ds.get('profile') == 'bochum'
+        assert shib_ds.get('sp_url') == 'https://bochum.example.org/Shibboleth.sso/Login'
+
+    def test_templatetag(self, rf, profiles):
+        request = rf.get('/')
+        request.COOKIES = {}
+        shib_ds = shib_ds_context(RequestContext(request, {}), 'bochum')
+        assert shib_ds.get('profile') == 'bochum'
+        assert shib_ds.get('return_id_param') == 'providerId'
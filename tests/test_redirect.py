@@ -0,0 +1,77 @@
+import pytest
+
+from urllib.parse import urlencode
+
+from django.conf import settings
+
+from shibboleth_discovery import redirect
+from shibboleth_discovery.redirect import clear
+from shibboleth_discovery.redirect import get_base
+from shibboleth_discovery.redirect import get_redirect_url
+from shibboleth_discovery.redirect import get_target_path
+
+
+IDP_DA = 'https://idp.hrz.tu-darmstadt.de/idp/shibboleth'
+
+
+@pytest.fixture(autouse=True)
+def clear_bases():
+    clear()
+    yield
+    clear()
+
+
+class TestTargetPath:
+
+    @pytest.mark.parametrize('next_url, expected', [
+        ('', '/'),
+        ('/spam?ham=eggs#top', '/spam?ham=eggs#top'),
+        ('spam', '/spam'),
+        ('https://testserver/spam?ham=eggs', '/spam?ham=eggs'),
+        ('http://testserver/spam', '/spam'),
+        # Other hosts are not allowed
+        ('https://evil.example.org/spam', '/'),
+        ('//evil.example.org/spam', '/'),
+        ('/\\evil.example.org/spam', '/'),
+        ('javascript:alert(1)', '/'),
+        # Control characters are dropped
+        ('/spam\nham', '/spamham'),
+    ])
+    def test_target_path(self, rf, next_url, expected):
+        assert get_target_path(rf.get('/'), next_url, 'testserver') == expected
+
+
+class TestRedirectUrl:
+
+    @pytest.fixture
+    def sites(self, monkeypatch):
+        calls = []
+        get_current_site = redirect.get_current_site
+        monkeypatch.setattr(redirect, 'get_current_site', lambda request: calls.append(request) or get_current_site(request))
+        return calls
+
+    def test_redirect_url(self, rf):
+        url = get_redirect_url(rf.get('/', {'next' : '/spam?ham=eggs'}), IDP_DA)
+        assert url == '{}?{}'.format(settings.SHIB_DS_SP_URL, urlencode({'target' : 'https://testserver/spam?ham=eggs', 'entityID' : IDP_DA}))
+
+    def test_site_resolved_once(self, rf, sites, settings):
+        settings.ALLOWED_HOSTS = ['testserver', 'other.testserver']
+        get_redirect_url(rf.get('/', {'next' : '/spam'}), IDP_DA)
+        get_redirect_url(rf.get('/', {'next' : '/ham'}), IDP_DA)
+        assert len(sites) == 1
+        get_redirect_url(rf.get('/', HTTP_HOST='other.testserver'), IDP_DA)
+        assert len(sites) == 2
+
+    def test_changed_settings(self, rf, settings):
+        get_redirect_url(rf.get('/'), IDP_DA)
+        settings.SHIB_DS_SP_URL = 'https://sp.example.org/Shibboleth.sso/Login?forceAuthn=true'
+        settings.SHIB_DS_RETURN_ID_PARAM = 'providerId'
+        url = get_redirect_url(rf.get('/'), IDP_DA)
+        assert url == 'https://sp.example.org/Shibboleth.sso/Login?forceAuthn=true&{}'.format(urlencode({'target' : 'https://testserver/', 'providerId' : IDP_DA}))
+
+    def test_bounded(self, rf, monkeypatch, settings):
+        settings.ALLOWED_HOSTS = ['.testserver']
+        monkeypatch.setattr(redirect, 'MAX_BASES', 2)
+        for host in ('a.testserver', 'b.testserver', 'c.testserver'):
+            get_base(rf.get('/', HTTP_HOST=host))
+        assert len(redirect._bases) == 1
@@ -0,0 +1,186 @@
+import pickle
+import pytest
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+
+from shibboleth_discovery import storage
+from shibboleth_discovery.storage import CacheWriteError
+from shibboleth_discovery.storage import get_codec
+from shibboleth_discovery.storage import get_part_key
+from shibboleth_discovery.storage import get_shard_key
+from shibboleth_discovery.storage import read_prepared
+from shibboleth_discovery.storage import read_snapshot
+from shibboleth_discovery.storage import write_prepared
+from shibboleth_discovery.storage import write_snapshot
+from shibboleth_discovery.utils import prepare_data
+
+
+class RejectingCache:
+    """
+    Wraps the cache and rejects the keys containing a string, like memcached does for values that are too large
+    """
+
+    def __init__(self, cache, rejected):
+        self.cache = cache
+        self.rejected = rejected
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def set_many(self, data, timeout=None):
+        failed = [key for key in data if self.rejected in key]
+        self.cache.set_many({key : value for key, value in data.items() if key not in failed}, timeout=timeout)
+        return failed
+
+
+class TestCodec:
+
+    @pytest.mark.parametrize('name', [None, 'zlib'])
+    def test_round_trip(self, name):
+        compress, decompress = get_codec(name)
+        assert decompress(compress(b'spam' * 100)) == b'spam' * 100
+
+    def test_unknown_codec(self):
+        with pytest.raises(ImproperlyConfigured):
+            get_codec('spam')
+
+
+class TestPrepared:
+
+    key = 'shib_ds_test'
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        cache.clear()
+
+    @pytest.mark.parametrize('codec', [None, 'zlib'])
+    def test_write_read(self, settings, codec):
+        settings.SHIB_DS_CACHE_COMPRESSION = codec
+        data = prepare_data()
+        version = write_prepared(self.key, data, timeout=60)
+        assert read_prepared(self.key) == (version, data)
+
+    def test_sharding(self, settings):
+        settings.SHIB_DS_CACHE_SHARD_SIZE = 100
+        data = prepare_data()
+        version = write_prepared(self.key, data, timeout=60)
+        pointer = cache.get(self.key)
+        assert pointer.get('version') == version
+        assert pointer.get('shards') > 1
+        assert all(len(cache.get(get_shard_key(self.key, version, number))) <= 100 for number in range(pointer.get('shards')))
+        assert read_prepared(self.key) == (version, data)
+
+    def test_missing_shard(self, settings):
+        settings.SHIB_DS_CACHE_SHARD_SIZE = 100
+        version = write_prepared(self.key, prepare_data(), timeout=60)
+        cache.delete(get_shard_key(self.key, version, 1))
+        assert read_prepared(self.key) == (None, None)
+
+    def test_version_independent_of_codec(self, settings):
+        idps, index = prepare_data()
+        data = {'idps' : idps, 'index' : index}
+        version = write_prepared(self.key, data, timeout=60)
+        settings.SHIB_DS_CACHE_COMPRESSION = 'zlib'
+        assert write_prepared(self.key, data, timeout=60) == version
+        assert write_prepared(self.key, data, timeout=60, lazy=('index',)) == version
+
+    def test_rejected_shard(self, settings, monkeypatch):
+        settings.SHIB_DS_CACHE_SHARD_SIZE = 100
+        version = write_prepared(self.key, ['spam'], timeout=60)
+        monkeypatch.setattr(storage, 'cache', RejectingCache(cache, ':1'))
+        with pytest.raises(CacheWriteError):
+            write_prepared(self.key, prepare_data(), timeout=60)
+        # The pointer still refers to the complete data
+        assert read_prepared(self.key) == (version, ['spam'])
+        assert [key for key in cache._cache if 'shib_ds_test:' in key and version not in key] == []
+
+    def test_not_cached(self):
+        assert read_prepared(self.key) == (None, None)
+
+    def test_version_flip(self):
+        version_old = write_prepared(self.key, ['spam'], timeout=60)
+        version_new = write_prepared(self.key, ['ham'], timeout=60)
+        assert version_old != version_new
+        assert read_prepared(self.key) == (version_new, ['ham'])
+        # Same content, same version
+        assert write_prepared(self.key, ['ham'], timeout=60) == version_new
+
+
+class TestLazyParts:
+
+    key = 'shib_ds_test'
+    data = {'idps' : ['spam'], 'fuzzy' : {'ham' : [0]}, 'domains' : {'eggs' : [0]}}
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        cache.clear()
+        yield
+        cache.clear()
+
+    def test_lazy(self):
+        version = write_prepared(self.key, self.data, timeout=60, lazy=('fuzzy', 'domains'))
+        # The version does not depend on the lazy parts
+        assert version == write_prepared('shib_ds_other', self.data, timeout=60)
+        read_version, data = read_prepared(self.key)
+        assert read_version == version
+        assert list(data.keys()) == ['idps']
+        assert data['fuzzy'] == {'ham' : [0]}
+        assert list(data.keys()) == ['idps', 'fuzzy']
+        assert data == self.data
+        assert pickle.loads(pickle.dumps(data)) == self.data
+        with pytest.raises(KeyError):
+            data['spam']
+
+    def test_evicted_part(self):
+        version = write_prepared(self.key, self.data, timeout=60, lazy=('fuzzy',))
+        cache.delete(get_part_key(self.key, version, 'fuzzy', 0))
+        assert read_prepared(self.key, lambda part, data: 'rebuilt')[1]['fuzzy'] == 'rebuilt'
+        with pytest.raises(KeyError):
+            read_prepared(self.key)[1]['fuzzy']
+
+
+class TestSnapshot:
+
+    @pytest.fixture
+    def path(self, tmp_path):
+        return str(tmp_path / 'snapshot')
+
+    @pytest.mark.parametrize('codec', [None, 'zlib'])
+    def test_write_read(self, settings, path, codec):
+        settings.SHIB_DS_CACHE_COMPRESSION = codec
+        data = prepare_data()
+        version = write_snapshot(path, data)
+        assert read_snapshot(path) == (version, data)
+
+    def test_same_version_as_cache(self, path):
+        data = prepare_data()
+        assert write_snapshot(path, data) == write_prepared('shib_ds_test', data, timeout=60)
+
+    def test_overwrite(self, path, tmp_path):
+        write_snapshot(path, ['spam'])
+        version = write_snapshot(path, ['ham'])
+        assert read_snapshot(path) == (version, ['ham'])
+        # No temporary files are left behind
+        assert [p.name for p in tmp_path.iterdir()] == ['snapshot']
+
+    def test_missing(self, path):
+        assert read_snapshot(path) == (None, None)
+
+    def test_corrupt(self, path):
+        with open(path, 'wb') as fout:
+            fout.write(b'spam')
+        assert read_snapshot(path) == (None, None)
+
+    def test_other_format(self, path):
+        write_snapshot(path, ['spam'])
+        with open(path, 'rb') as fin:
+            snapshot = pickle.load(fin)
+        snapshot['format'] = 0
+        with open(path, 'wb') as fout:
+            pickle.dump(snapshot, fout)
+        assert read_snapshot(path) == (None, None)
+
+    def test_unwritable(self, tmp_path):
+        with pytest.raises(OSError):
+            write_snapshot(str(tmp_path / 'spam' / 'snapshot'), ['spam'])
@@ -1,10 +1,17 @@
 import pytest
 
+from shibboleth_discovery.helpers import select2_processor
+from shibboleth_discovery.storage import write_prepared
+from shibboleth_discovery.template_tags import shibboleth_discovery as template_tags
 from shibboleth_discovery.template_tags.shibboleth_discovery import shib_ds_context
+from shibboleth_discovery.template_tags.shibboleth_discovery import shib_ds_recent_idps
 from shibboleth_discovery.utils import b64encode_idp
+from shibboleth_discovery.utils import get_or_set_prepared
 
 from django.conf import settings
+from django.core.cache import cache
 from django.template import RequestContext
+from django.utils import translation
 from django.urls import reverse
 
 from tests.conftest import RECENT_IDP_SCENARIOS
@@ -47,3 +54,58 @@ class TestShibDS:
     def test_target(self, client):
         shib_ds = self.get_shib_ds('?next=spam')
         assert shib_ds.get('next') == 'spam'
+
+
+class TestRecentIdpsFragment:
+
+    base_url = reverse('login-mixin')
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self, rf):
+        self.rf = rf
+        cache.clear()
+        yield
+        cache.clear()
+
+    @pytest.fixture
+    def renders(self, monkeypatch):
+        calls = []
+        render = template_tags.render_to_string
+        monkeypatch.setattr(template_tags, 'render_to_string', lambda *args, **kwargs: calls.append(args) or render(*args, **kwargs))
+        return calls
+
+    def render(self, idps=(), language='en'):
+        request = self.rf.get(self.base_url)
+        request.COOKIES = {settings.SHIB_DS_COOKIE_NAME : ' '.join(map(b64encode_idp, idps))}
+        with translation.override(language):
+            return shib_ds_recent_idps(RequestContext(request, {}))
+
+    def test_render(self):
+        fragment = self.render(['https://idp.hrz.tu-darmstadt.de/idp/shibboleth'])
+        assert 'value="https://idp.hrz.tu-darmstadt.de/idp/shibboleth"' in fragment
+        assert 'Kassel' not in fragment
+        assert self.render().strip() == ''
+
+    def test_post_processor(self, settings):
+        settings.SHIB_DS_POST_PROCESSOR = select2_processor
+        fragment = self.render(['https://idp.hrz.tu-darmstadt.de/idp/shibboleth'])
+        assert 'value="https://idp.hrz.tu-darmstadt.de/idp/shibboleth"' in fragment
+        assert 'Technische Universität Darmstadt' in fragment
+
+    def test_cached(self, renders):
+        assert self.render(['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']) == self.render(['https://idp.hrz.tu-darmstadt.de/idp/shibboleth'])
+        assert len(renders) == 1
+
+    def test_key(self, renders):
+        self.render(['https://idp.hrz.tu-darmstadt.de/idp/shibboleth'])
+        self.render(['https://idp.hrz.uni-kassel.de/idp/shibboleth-idp'])
+        self.render(['https://idp.hrz.tu-darmstadt.de/idp/shibboleth'], language='de')
+        assert len(renders) == 3
+
+    def test_new_version(self, renders):
+        self.render(['https://idp.hrz.tu-darmstadt.de/idp/shibboleth'])
+        version, data = get_or_set_prepared()
+        data['idps'] = data['idps'][:1]
+        write_prepared('shib_ds', data, timeout=None)
+        self.render(['https://idp.hrz.tu-darmstadt.de/idp/shibboleth'])
+        assert len(renders) == 2
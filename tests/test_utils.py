@@ -3,12 +3,28 @@ import pytest
 import responses
 
 from django.conf import settings
-
+from django.core.cache import cache
+
+from shibboleth_discovery import utils
+from shibboleth_discovery.fuzzy import build_fuzzy_index
+from shibboleth_discovery.loadtest import CacheCounter
+from shibboleth_discovery.storage import get_part_key
+from shibboleth_discovery.utils import build_index
+from shibboleth_discovery.utils import get_or_set_prepared
+from shibboleth_discovery.utils import search_domain
 from shibboleth_discovery.utils import b64decode_idp, b64encode_idp
+from shibboleth_discovery.utils import build_facets
+from shibboleth_discovery.utils import get_context
+from shibboleth_discovery.utils import get_facet_mask
+from shibboleth_discovery.utils import decode_cursor, encode_cursor
 from shibboleth_discovery.utils import get_feed
 from shibboleth_discovery.utils import get_recent_idps
+from shibboleth_discovery.utils import iter_bitset, to_bitset
+from shibboleth_discovery.utils import iter_matches
 from shibboleth_discovery.utils import prepare_data
+from shibboleth_discovery.utils import prepare_feed
 from shibboleth_discovery.utils import search
+from shibboleth_discovery.utils import search_page
 
 from tests.conftest import RECENT_IDP_SCENARIOS
 
@@ -91,6 +107,20 @@ class TestPrepareData:
         assert all(name in index[2] for name in names)
 
 
+    def test_metadata(self):
+        idps, index = prepare_data()
+
+        assert idps[0].get('information_url') == {'de' : 'http://www.hrz.tu-darmstadt.de', 'en' : 'http://www.hrz.tu-darmstadt.de'}
+        assert idps[0].get('privacy_statement_url') == {'de' : 'https://www.aai.dfn.de/fileadmin/documents/datenschutz/ausgelagerter_idp.html'}
+        assert idps[0].get('registration_authority') == 'https://www.aai.dfn.de'
+        assert idps[0].get('entity_categories') == ['http://refeds.org/category/research-and-scholarship']
+        assert idps[0].get('domain_hints') == ['tu-darmstadt.de']
+
+        # Bochum has no metadata at all
+        assert idps[2].get('information_url') == {}
+        assert idps[2].get('registration_authority') is None
+        assert idps[2].get('entity_categories') == []
+
     def test_get_largest_logo(self):
         idps, index = prepare_data()
 
@@ -147,6 +177,50 @@ SEARCH_SCENARIOS = [
     ),
 ]
 
+class TestBitset:
+
+    @pytest.mark.parametrize('positions', [[], [0], [1, 7, 8, 100]])
+    def test_round_trip(self, positions):
+        assert list(iter_bitset(to_bitset(positions))) == positions
+
+    def test_start(self):
+        assert list(iter_bitset(to_bitset([1, 7, 8, 100]), 8)) == [8, 100]
+
+
+class TestFacets:
+
+    def test_build_facets(self):
+        idps, index = prepare_data()
+        facets = build_facets(idps)
+        assert facets.get('registration_authority') == {'https://www.aai.dfn.de' : 0b011}
+        assert facets.get('entity_category') == {'http://refeds.org/category/research-and-scholarship' : 0b001}
+        assert facets.get('domain_hint') == {'tu-darmstadt.de' : 0b001}
+
+    @pytest.mark.parametrize('facets, expected', [
+        (None, None),
+        ({}, None),
+        ({'registration_authority' : []}, None),
+        ({'registration_authority' : ['https://www.aai.dfn.de']}, 0b011),
+        ({'registration_authority' : ['spam']}, 0),
+        ({'registration_authority' : ['https://www.aai.dfn.de'], 'entity_category' : ['http://refeds.org/category/research-and-scholarship']}, 0b001),
+        ({'domain_hint' : ['tu-darmstadt.de', 'spam']}, 0b001),
+    ])
+    def test_get_facet_mask(self, facets, expected):
+        assert get_facet_mask(facets, prepare_feed()) == expected
+
+    def test_unknown_facet(self):
+        with pytest.raises(ValueError):
+            get_facet_mask({'spam' : ['ham']}, prepare_feed())
+
+    @pytest.mark.parametrize('facets, expected', [
+        ({'registration_authority' : ['https://www.aai.dfn.de']}, ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth', 'https://idp.hrz.uni-kassel.de/idp/shibboleth-idp']),
+        ({'entity_category' : ['http://refeds.org/category/research-and-scholarship']}, ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']),
+        ({'registration_authority' : ['spam']}, []),
+    ])
+    def test_search(self, facets, expected):
+        assert [result.get('entity_id') for result in search([''], facets=facets)] == expected
+
+
 class TestSearch:
 
     @pytest.mark.parametrize('tokens, expected', SEARCH_SCENARIOS)
@@ -154,6 +228,91 @@ class TestSearch:
         results = [result.get('entity_id') for result in search(tokens)]
         assert results == expected
 
+    @pytest.mark.parametrize('tokens, expected', [
+        (['Darmstdat'], ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']),
+        (['Darmstdat', 'Techn'], ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']),
+        (['Darmstdat', 'Kassel'], []),
+        (['Universitat'], ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth', 'https://idp.hrz.uni-kassel.de/idp/shibboleth-idp']),
+        (['Darmstadt'], ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']),
+    ])
+    def test_fuzzy_search(self, tokens, expected):
+        assert [result.get('entity_id') for result in search(tokens, fuzzy=True)] == expected
+        # Without fuzzy mode, there are only exact matches
+        assert all(result.get('entity_id') in expected for result in search(tokens))
+
+    def test_fuzzy_exact_first(self):
+        index = ['darmstdat', 'kassel', 'darmstadt']
+        data = {
+            'idps' : index,
+            'index' : index,
+            'fuzzy' : build_fuzzy_index(index, 1),
+        }
+        assert list(iter_matches(['darmstadt'], data, fuzzy=True)) == [(2, 'darmstadt'), (3, 'darmstdat')]
+        # Resuming in the fuzzy part
+        assert list(iter_matches(['darmstadt'], data, start=3, fuzzy=True)) == [(3, 'darmstdat')]
+        # Fuzzy matches respect the mask
+        assert list(iter_matches(['darmstadt'], data, mask=0b100, fuzzy=True)) == [(2, 'darmstadt')]
+
+
+class TestLazyIndexes:
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        cache.clear()
+        yield
+        cache.clear()
+
+    def test_loaded_on_use(self):
+        get_or_set_prepared()
+        version, data = get_or_set_prepared()
+        search(['Darmstadt'], data=data)
+        assert 'fuzzy' not in data.keys() and 'domains' not in data.keys()
+        search(['Darmstdat'], data=data, fuzzy=True)
+        assert 'fuzzy' in data.keys()
+
+    def test_evicted(self):
+        version, data = get_or_set_prepared()
+        pointer = cache.get('shib_ds')
+        cache.delete_many([get_part_key('shib_ds', version, part, 0) for part in pointer['parts']])
+        version, data = get_or_set_prepared()
+        assert data['fuzzy'] == build_index('fuzzy', data)
+        assert [idp.get('entity_id') for idp in search_domain('user@tu-darmstadt.de', data=data)] == ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']
+
+
+class TestCursor:
+
+    def test_round_trip(self):
+        assert decode_cursor(encode_cursor('spam', 42), 'spam') == (42, [])
+        assert decode_cursor(encode_cursor('spam', 42, [2, 0]), 'spam') == (42, [2, 0])
+
+    @pytest.mark.parametrize('cursor', ['spam', '', encode_cursor('spam', 'ham'), encode_cursor('spam', -1), encode_cursor('spam', 1, ['ham']), encode_cursor('spam', 1, [-1])])
+    def test_invalid(self, cursor):
+        with pytest.raises(ValueError):
+            decode_cursor(cursor, 'spam')
+
+    def test_expired(self):
+        with pytest.raises(ValueError):
+            decode_cursor(encode_cursor('spam', 42), 'ham')
+
+
+class TestSearchPage:
+
+    def test_pages(self):
+        results, cursor = search_page(['Universität'], 1)
+        assert [result.get('entity_id') for result in results] == ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']
+        results, cursor = search_page(['Universität'], 1, cursor)
+        assert [result.get('entity_id') for result in results] == ['https://idp.hrz.uni-kassel.de/idp/shibboleth-idp']
+        assert cursor is None
+
+    def test_no_tokens(self):
+        get_or_set_prepared()
+        # An empty query does not touch the cache
+        with CacheCounter().patch() as counter:
+            assert search_page([], 1) == ([], None)
+        assert counter.calls == 0
+        with pytest.raises(ValueError):
+            search_page([], 1, facets={'spam' : ['ham']})
+
 
 class TestGetRecentIdPs:
 
@@ -172,3 +331,10 @@ class TestGetRecentIdPs:
         request.COOKIES = cookies
         recent_idps = get_recent_idps(request)
         assert set(idp.get('entity_id') for idp in recent_idps) == set(expected)
+
+    def test_context_loads_once(self, rf, monkeypatch):
+        calls = []
+        read_prepared = utils.read_prepared
+        monkeypatch.setattr(utils, 'read_prepared', lambda *args: calls.append(args) or read_prepared(*args))
+        get_context(rf.get('/'))
+        assert len(calls) == 1
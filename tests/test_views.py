@@ -6,10 +6,14 @@ from urllib.parse import urlparse
 from urllib.parse import urlunparse
 from django.conf import settings
 from django.urls import reverse
+from django.utils import translation
 
+from shibboleth_discovery import views
 from shibboleth_discovery.helpers import select2_processor
 from shibboleth_discovery.utils import b64encode_idp
+from shibboleth_discovery.utils import encode_cursor
 
+from .test_coalesce import run_async
 from .test_utils import SEARCH_SCENARIOS
 
 
@@ -62,6 +66,85 @@ class TestSearchView:
         assert len(json.loads(r.content.decode('utf-8')).get('results')) == 1
 
 
+    def test_search_cursor(self, settings, client):
+        settings.SHIB_DS_MAX_RESULTS = 1
+        url = reverse('shib_ds:search')
+        results = []
+        cursors = []
+        cursor = None
+        while True:
+            r = client.get(url, {'q' : 'a', 'cursor' : cursor} if cursor else {'q' : 'a'})
+            content = json.loads(r.content.decode('utf-8'))
+            results += [result.get('entity_id') for result in content.get('results')]
+            cursor = content.get('cursor')
+            if not cursor:
+                break
+            cursors.append(cursor)
+        assert len(cursors) == 2
+        assert results == [
+            'https://idp.hrz.tu-darmstadt.de/idp/shibboleth',
+            'https://idp.hrz.uni-kassel.de/idp/shibboleth-idp',
+            'https://idp.hs-bochum.de/idp/shibboleth'
+        ]
+
+    def test_search_cursor_last_page(self, client):
+        r = client.get(reverse('shib_ds:search') + "?q=Darmstadt")
+        assert json.loads(r.content.decode('utf-8')).get('cursor') is None
+
+    @pytest.mark.parametrize('cursor', ['spam', encode_cursor('spam', 1)])
+    def test_search_invalid_cursor(self, client, cursor):
+        r = client.get(reverse('shib_ds:search'), {'q' : 'a', 'cursor' : cursor})
+        assert r.status_code == 400
+
+    @pytest.mark.parametrize('params, expected', [
+        ({'registration_authority' : 'https://www.aai.dfn.de'}, ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth', 'https://idp.hrz.uni-kassel.de/idp/shibboleth-idp']),
+        ({'registration_authority' : 'https://www.aai.dfn.de', 'entity_category' : 'http://refeds.org/category/research-and-scholarship'}, ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']),
+        ({'domain_hint' : ['spam', 'tu-darmstadt.de']}, ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']),
+        ({'registration_authority' : 'spam'}, []),
+    ])
+    def test_search_facets(self, client, params, expected):
+        r = client.get(reverse('shib_ds:search'), dict(params, q='Universität'))
+        assert [result.get('entity_id') for result in json.loads(r.content.decode('utf-8')).get('results')] == expected
+
+    def test_search_fuzzy(self, client, settings):
+        r = client.get(reverse('shib_ds:search'), {'q' : 'Universitat'})
+        assert json.loads(r.content.decode('utf-8')).get('results') == []
+        settings.SHIB_DS_FUZZY_SEARCH = True
+        settings.SHIB_DS_MAX_RESULTS = 1
+        r = client.get(reverse('shib_ds:search'), {'q' : 'Universitat'})
+        content = json.loads(r.content.decode('utf-8'))
+        assert [result.get('entity_id') for result in content.get('results')] == ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']
+        r = client.get(reverse('shib_ds:search'), {'q' : 'Universitat', 'cursor' : content.get('cursor')})
+        content = json.loads(r.content.decode('utf-8'))
+        assert [result.get('entity_id') for result in content.get('results')] == ['https://idp.hrz.uni-kassel.de/idp/shibboleth-idp']
+        assert content.get('cursor') is None
+
+    @pytest.mark.parametrize('query, expected', [
+        ('user@tu-darmstadt.de', ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']),
+        ('user@uni-kassel.de', ['https://idp.hrz.uni-kassel.de/idp/shibboleth-idp']),
+        # Unknown domains fall back to the search
+        ('user@spam.de', []),
+    ])
+    def test_search_email(self, client, query, expected):
+        r = client.get(reverse('shib_ds:search'), {'q' : query})
+        assert [result.get('entity_id') for result in json.loads(r.content.decode('utf-8')).get('results')] == expected
+
+    def test_search_email_facets(self, client):
+        params = {'entity_category' : 'http://refeds.org/category/research-and-scholarship'}
+        # Kassel is not in the category, like in the search by name
+        for query in ('Kassel', 'user@uni-kassel.de'):
+            r = client.get(reverse('shib_ds:search'), dict(params, q=query))
+            assert json.loads(r.content.decode('utf-8')).get('results') == []
+        r = client.get(reverse('shib_ds:search'), dict(params, q='user@tu-darmstadt.de'))
+        assert [result.get('entity_id') for result in json.loads(r.content.decode('utf-8')).get('results')] == ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']
+
+    def test_search_metadata(self, client):
+        r = client.get(reverse('shib_ds:search'), {'q' : 'Darmstadt'})
+        result = json.loads(r.content.decode('utf-8')).get('results')[0]
+        assert result.get('information_url') == 'http://www.hrz.tu-darmstadt.de'
+        # Falls back to any language
+        assert result.get('privacy_statement_url') == 'https://www.aai.dfn.de/fileadmin/documents/datenschutz/ausgelagerter_idp.html'
+
     def test_select2_post_processor(self, client, settings):
         settings.SHIB_DS_POST_PROCESSOR = select2_processor
         url = reverse('shib_ds:search') + "?q=Bochum"
@@ -70,6 +153,150 @@ class TestSearchView:
         assert json.loads(r.content.decode('utf-8')).get('results')[0].get('text') == 'Bochum University Of Applied Sciences'
 
 
+    def test_search_method(self, rf):
+        view = views.SearchView()
+        view.setup(rf.get('/'))
+        assert [idp.get('entity_id') for idp in view.search('Universität', limit=1)] == ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']
+
+    def test_search_override(self, rf):
+        class CustomSearchView(views.SearchView):
+            def search(self, query, limit=None):
+                return super().search('Bochum', limit)
+
+        r = CustomSearchView.as_view()(rf.get('/', {'q' : 'Darmstadt'}))
+        result = json.loads(r.content.decode('utf-8'))
+        assert [idp.get('entity_id') for idp in result.get('results')] == ['https://idp.hs-bochum.de/idp/shibboleth']
+        assert result.get('cursor') is None
+
+    def test_search_override_without_limit(self, rf, settings):
+        # Overrides written before search had a limit
+        class LegacySearchView(views.SearchView):
+            def search(self, query):
+                return super().search('Universität')
+
+        settings.SHIB_DS_MAX_RESULTS = 1
+        r = LegacySearchView.as_view()(rf.get('/', {'q' : 'Darmstadt'}))
+        result = json.loads(r.content.decode('utf-8'))
+        assert [idp.get('entity_id') for idp in result.get('results')] == ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']
+
+
+class TestAsyncSearchView:
+
+    @pytest.fixture
+    def view(self):
+        view = views.AsyncSearchView.as_view()
+        return lambda request: run_async(view(request))
+
+    def test_search(self, rf, view):
+        r = view(rf.get('/', {'q' : 'Darmstadt'}))
+        assert [idp.get('entity_id') for idp in json.loads(r.content.decode('utf-8')).get('results')] == ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']
+
+    @pytest.mark.parametrize('language, expected', [('en', 'Bochum University Of Applied Sciences'), ('de', 'Hochschule Bochum')])
+    def test_localization(self, rf, view, language, expected):
+        with translation.override(language):
+            r = view(rf.get('/', {'q' : 'Bochum'}))
+        assert json.loads(r.content.decode('utf-8')).get('results')[0].get('name') == expected
+
+    def test_invalid_cursor(self, rf, view):
+        assert view(rf.get('/', {'q' : 'a', 'cursor' : 'spam'})).status_code == 400
+
+    def test_method_not_allowed(self, rf, view):
+        assert view(rf.post('/')).status_code == 405
+
+
+class TestDomainLookupView:
+
+    @pytest.mark.parametrize('query, expected', [
+        ('user@tu-darmstadt.de', ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']),
+        ('hs-bochum.de', ['https://idp.hs-bochum.de/idp/shibboleth']),
+        ('user@spam.de', []),
+        ('', []),
+    ])
+    def test_lookup(self, client, query, expected):
+        r = client.get(reverse('shib_ds:lookup'), {'q' : query})
+        assert [result.get('entity_id') for result in json.loads(r.content.decode('utf-8')).get('results')] == expected
+
+    def test_post_processor(self, client, settings):
+        settings.SHIB_DS_POST_PROCESSOR = select2_processor
+        r = client.get(reverse('shib_ds:lookup'), {'q' : 'user@tu-darmstadt.de'})
+        assert json.loads(r.content.decode('utf-8')).get('results')[0].get('id') == 'https://idp.hrz.tu-darmstadt.de/idp/shibboleth'
+
+
+class TestBatchSearchView:
+
+    url = reverse('shib_ds:batch-search')
+
+    def post(self, client, data):
+        return client.post(self.url, data, 'application/json')
+
+    def test_batch_search(self, client):
+        r = self.post(client, {'queries' : ['Darmstadt', {'query' : 'Universität'}, {'query' : ''}]})
+        assert r.status_code == 200
+        results = json.loads(r.content.decode('utf-8')).get('results')
+        assert [result.get('query') for result in results] == ['Darmstadt', 'Universität', '']
+        assert [[idp.get('entity_id') for idp in result.get('results')] for result in results] == [
+            ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth'],
+            ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth', 'https://idp.hrz.uni-kassel.de/idp/shibboleth-idp'],
+            [],
+        ]
+
+    def test_limit(self, client):
+        r = self.post(client, {'queries' : [{'query' : 'Universität', 'limit' : 1}]})
+        assert len(json.loads(r.content.decode('utf-8')).get('results')[0].get('results')) == 1
+
+    def test_language(self, client):
+        r = self.post(client, {'queries' : [{'query' : 'Bochum', 'language' : 'de'}, {'query' : 'Bochum', 'language' : 'en'}]})
+        results = json.loads(r.content.decode('utf-8')).get('results')
+        assert results[0].get('results')[0].get('name') == 'Hochschule Bochum'
+        assert results[1].get('results')[0].get('name') == 'Bochum University Of Applied Sciences'
+
+    def test_facets(self, client):
+        r = self.post(client, {'queries' : [{'query' : 'Universität', 'facets' : {'entity_category' : ['http://refeds.org/category/research-and-scholarship']}}]})
+        results = json.loads(r.content.decode('utf-8')).get('results')
+        assert [idp.get('entity_id') for idp in results[0].get('results')] == ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']
+
+    def test_fuzzy(self, client):
+        r = self.post(client, {'queries' : [{'query' : 'Darmstdat', 'fuzzy' : True}, {'query' : 'Darmstdat'}]})
+        results = json.loads(r.content.decode('utf-8')).get('results')
+        assert [idp.get('entity_id') for idp in results[0].get('results')] == ['https://idp.hrz.tu-darmstadt.de/idp/shibboleth']
+        assert results[1].get('results') == []
+
+    def test_post_processor(self, client, settings):
+        settings.SHIB_DS_POST_PROCESSOR = select2_processor
+        r = self.post(client, {'queries' : ['Bochum', 'Bochum']})
+        results = json.loads(r.content.decode('utf-8')).get('results')
+        assert all(result.get('results')[0].get('id') == 'https://idp.hs-bochum.de/idp/shibboleth' for result in results)
+
+    @pytest.mark.parametrize('data', [
+        'This is not JSON',
+        ['Darmstadt'],
+        {'spam' : 'ham'},
+        {'queries' : []},
+        {'queries' : [1]},
+        {'queries' : [{'query' : 'Darmstadt', 'limit' : 0}]},
+        {'queries' : [{'query' : 'Darmstadt', 'limit' : 'spam'}]},
+        {'queries' : [{'query' : 'Darmstadt', 'limit' : True}]},
+        {'queries' : [{'query' : 'Darmstadt', 'language' : 1}]},
+        {'queries' : [{'query' : 'Darmstadt', 'facets' : ['spam']}]},
+        {'queries' : [{'query' : 'Darmstadt', 'fuzzy' : 'spam'}]},
+        {'queries' : [{'query' : 'Darmstadt', 'facets' : {'spam' : ['ham']}}]},
+        {'queries' : [{'query' : 'Darmstadt', 'facets' : {'domain_hint' : 'tu-darmstadt.de'}}]},
+        {'queries' : [{'query' : 'Darmstadt', 'facets' : {'domain_hint' : [['tu-darmstadt.de']]}}]},
+    ])
+    def test_bad_request(self, client, data):
+        r = self.post(client, data)
+        assert r.status_code == 400
+
+    def test_invalid_encoding(self, client):
+        r = client.post(self.url, b'{"queries" : ["\xff"]}', 'application/json')
+        assert r.status_code == 400
+
+    def test_max_batch_queries(self, client, settings):
+        settings.SHIB_DS_MAX_BATCH_QUERIES = 1
+        r = self.post(client, {'queries' : ['Darmstadt', 'Kassel']})
+        assert r.status_code == 400
+
+
 class TestSetCookieView:
 
     def test_set_cookie(self, client):